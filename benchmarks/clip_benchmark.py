@@ -0,0 +1,69 @@
+"""Compares encode time and output size of the GIF/WEBM clip commands against the previous bare FFmpeg commands.
+
+Usage (from the repository root, like the server):
+    poetry run python benchmarks/clip_benchmark.py input.mp4 --start 0 --end 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from server.server import clip_ffmpeg_options, load_server_config
+
+def legacy_cmd(input_path, output_path, startseconds, endseconds):
+    # The command handle_process_video_clip used before the GIF pipeline and WEBM profile
+    return ['ffmpeg', '-y', '-i', input_path, '-ss', str(startseconds), '-to', str(endseconds), output_path]
+
+def optimized_cmd(input_path, output_path, extension, startseconds, endseconds, config):
+    if extension == 'gif':
+        max_width, fps = config['gif_max_width'], config['gif_fps']
+    else:
+        max_width, fps = None, None
+    options = clip_ffmpeg_options(input_path, extension, startseconds, endseconds - startseconds, max_width, fps, config)
+    return ['ffmpeg', '-y'] + options + [output_path]
+
+def measure(ffmpeg_cmd, output_path, repeat):
+    """Returns the best wall time over repeat runs and the output size"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = subprocess.run(ffmpeg_cmd, capture_output=True)
+        elapsed = time.perf_counter() - started
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg error: {result.stderr.decode('utf-8', 'replace')[-500:]}")
+        best = elapsed if best is None else min(best, elapsed)
+    return best, os.path.getsize(output_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='GIF/WEBM clip benchmark')
+    parser.add_argument('input_path')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--end', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--extensions', nargs='+', default=['gif', 'webm'])
+    args = parser.parse_args()
+
+    config = load_server_config()
+
+    print(f"{'format':<8}{'command':<12}{'seconds':>10}{'bytes':>14}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for extension in args.extensions:
+            results = {}
+            for name, build in [
+                ('legacy', lambda path: legacy_cmd(args.input_path, path, args.start, args.end)),
+                ('optimized', lambda path: optimized_cmd(args.input_path, path, extension, args.start, args.end, config))
+            ]:
+                output_path = os.path.join(tmp_dir, f'{name}.{extension}')
+                results[name] = measure(build(output_path), output_path, args.repeat)
+                print(f"{extension:<8}{name:<12}{results[name][0]:>10.2f}{results[name][1]:>14}")
+
+            legacy_seconds, legacy_size = results['legacy']
+            optimized_seconds, optimized_size = results['optimized']
+            print(f"{extension:<8}{'ratio':<12}{optimized_seconds / legacy_seconds:>10.2f}{optimized_size / legacy_size:>14.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Measures server handshakes per second per core for the RSA and the X25519 handshake.
+
+The X25519 client signs the exchange with its RSA key, as the desktop client does, so the server's signature check is included.
+The server side runs perform_handshake from server/server.py on one thread, and a client thread performs the
+other side over a socket pair. Only the CPU time of the server thread is counted.
+
+Usage (from the repository root):
+    poetry run python benchmarks/handshake_benchmark.py --count 500
+"""
+import argparse
+import contextlib
+import io
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+
+from server import server
+
+def send_frame(connection, data):
+    connection.sendall(len(data).to_bytes(4, 'big') + data)
+
+def receive_frame(connection):
+    size = int.from_bytes(server.receive_exact(connection, 4), 'big')
+    return server.receive_exact(connection, size)
+
+def rsa_client(connection, client_key, count):
+    client_public_pem = client_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    for _ in range(count):
+        send_frame(connection, client_public_pem)
+        server_public_key = serialization.load_pem_public_key(receive_frame(connection))
+        aes_key = os.urandom(32)
+        send_frame(connection, server_public_key.encrypt(aes_key, padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)))
+
+def x25519_client(connection, client_key, count):
+    client_public_pem = client_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    for _ in range(count):
+        private_key = X25519PrivateKey.generate()
+        public_bytes = private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        send_frame(connection, bytes([server.HANDSHAKE_X25519]) + public_bytes + client_public_pem)
+        reply = receive_frame(connection)
+        send_frame(connection, client_key.sign(
+            server.HANDSHAKE_SIGNATURE_INFO + public_bytes + reply[1:],
+            padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=32),
+            hashes.SHA256()
+        ))
+        server.derive_session_key(private_key.exchange(X25519PublicKey.from_public_bytes(reply[1:])), public_bytes, reply[1:])
+
+def measure(client, client_key, count):
+    """Returns the CPU seconds the server thread spent on count handshakes"""
+    server_side, client_side = socket.socketpair()
+    client_thread = threading.Thread(target=client, args=(client_side, client_key, count), daemon=True)
+    client_thread.start()
+
+    started = time.thread_time()
+    for _ in range(count):
+        server.perform_handshake(server_side)
+    cpu_seconds = time.thread_time() - started
+
+    client_thread.join()
+    server_side.close()
+    client_side.close()
+    return cpu_seconds
+
+def main():
+    parser = argparse.ArgumentParser(description='Handshake benchmark')
+    parser.add_argument('--count', type=int, default=500)
+    args = parser.parse_args()
+
+    client_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    server.initialize_rsa()
+    started = time.perf_counter()
+    server.get_rsa_manager()
+    print(f"RSA-2048 key generation (once, on the first RSA handshake): {time.perf_counter() - started:.3f}s")
+
+    # The handshake functions log every connection
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {
+            'rsa': measure(rsa_client, client_key, args.count),
+            'x25519': measure(x25519_client, client_key, args.count)
+        }
+
+    print(f"{'handshake':<12}{'ms/handshake':>14}{'handshakes/s/core':>20}")
+    for name, cpu_seconds in results.items():
+        print(f"{name:<12}{cpu_seconds / args.count * 1000:>14.3f}{args.count / cpu_seconds:>20.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
-import { generateKeyPairSync, randomBytes, publicEncrypt, constants, createCipheriv, createDecipheriv } from "crypto";
-import { app, BrowserWindow, ipcMain, dialog, safeStorage } from "electron";
+import { generateKeyPairSync, randomBytes, randomUUID, publicEncrypt, constants, createCipheriv, createDecipheriv, createHash, createPublicKey, diffieHellman, hkdfSync, sign } from "crypto";
+import { app, BrowserWindow, ipcMain, dialog, safeStorage, shell } from "electron";
 import { stat } from "fs/promises";
 import * as path from "path";
 import * as fs from "fs";
@@ -13,6 +13,10 @@ interface ProcessingParams {
   endseconds?: number;
   extension?: string;
   outputFileName?: string;
+  protocol_version?: number;
+  upload_id?: string | null;
+  preview?: boolean;
+  content_hash?: string;
 }
 
 interface ProcessingRequest {
@@ -24,6 +28,7 @@ interface ServerConfig {
   server_address: string;
   server_port: number;
   stream_rate: number;
+  handshake: string;
 }
 
 interface KeyPaths {
@@ -31,7 +36,51 @@ interface KeyPaths {
   clientPublicPath: string;
 }
 
+interface EncryptedMessage {
+  code: number;
+  json: any;
+}
+
+// プロトコルバージョン2: サーバーがアップロードIDと再開位置を返す（再開可能アップロード）
+const PROTOCOL_VERSION = 2;
+const RESPONSE_ERROR = 0x00;
+const RESPONSE_UPLOAD_READY = 0x02;
+const RESPONSE_QUEUED = 0x04;
+const RESPONSE_PREVIEW = 0x05;
+// ハンドシェイクバージョン2: 使い捨てのX25519鍵でAES鍵を導出する（前方秘匿性あり）
+const HANDSHAKE_X25519 = 0x02;
+const HANDSHAKE_INFO = Buffer.from("video_compressor x25519 handshake", "utf8");
+const HANDSHAKE_SIGNATURE_INFO = Buffer.from("video_compressor client signature", "utf8");
+// 接続が切れた場合にアップロードを再開する最大回数
+const UPLOAD_RETRY_LIMIT = 3;
+const UPLOAD_RETRY_DELAY_MS = 2000;
+
+// 結果を受け取る前に接続が切れたことを表す。アップロードIDがあれば同じIDで再開できる
+class ConnectionLostError extends Error {}
+
+// サーバーがアップロード前にリクエストを拒否したことを表す（キューが満杯など）。すぐに再試行しても同じ結果になるため再試行しない
+class ServerRejectedError extends Error {
+  constructor(
+    message: string,
+    public retryAfter: number | null,
+  ) {
+    super(message);
+  }
+}
+
+// 処理中のリクエスト（キャンセル要求をサーバーに送るため）
+let activeSession: { socket: net.Socket; clientAesKey: Buffer } | null = null;
+// 保存待ちの結果ファイル。レンダラーにはパスを渡さず、結果IDだけで保存を依頼させる
+const pendingResults = new Map<string, string>();
+let cancelRequested = false;
+
+// クライアントの鍵はサーバーでの識別（重み付け・利用統計）に使うため、初回起動時のみ生成して使い続ける
 function generateCryptoKeys(): void {
+  const { securePrivatePath, clientPublicPath } = getKeyPaths();
+  if (fs.existsSync(securePrivatePath) && fs.existsSync(clientPublicPath)) {
+    return;
+  }
+
   const { publicKey, privateKey } = generateKeyPairSync("rsa", {
     modulusLength: 2048,
     publicKeyEncoding: {
@@ -46,12 +95,8 @@ function generateCryptoKeys(): void {
 
   const encryptedKey = safeStorage.encryptString(privateKey);
 
-  const saveDir = app.getPath("userData");
-  const SecurePrivateKeyPath = path.join(saveDir, "key.secure");
-  const PublicKeyPath = path.join(saveDir, "client_publicKey.pem");
-
-  fs.writeFileSync(SecurePrivateKeyPath, encryptedKey);
-  fs.writeFileSync(PublicKeyPath, publicKey);
+  fs.writeFileSync(securePrivatePath, encryptedKey);
+  fs.writeFileSync(clientPublicPath, publicKey);
 }
 
 // クライアント用のAES鍵を生成
@@ -165,12 +210,26 @@ ipcMain.handle(
   },
 );
 
+// サーバーに暗号化したキャンセルメッセージを送り、FFmpegの処理を止める
+ipcMain.handle("cancel-video-request", async () => {
+  cancelRequested = true;
+  if (activeSession) {
+    sendEncryptedMessage(activeSession.socket, { cancel: true }, activeSession.clientAesKey);
+  }
+});
+
 ipcMain.handle(
   "download-file",
   async (
     event,
-    fileData: { filename: string; fileData: any; fileExtension: string },
+    fileData: { filename: string; resultId: string; fileExtension: string },
   ) => {
+    const tempPath = pendingResults.get(fileData.resultId);
+    if (tempPath === undefined) {
+      throw new Error("Unknown result");
+    }
+    pendingResults.delete(fileData.resultId);
+
     try {
       const result = await dialog.showSaveDialog({
         defaultPath: fileData.filename,
@@ -181,20 +240,20 @@ ipcMain.handle(
       });
 
       if (!result.canceled && result.filePath) {
-        let bufferToWrite;
-
-        if (Buffer.isBuffer(fileData.fileData)) {
-          bufferToWrite = fileData.fileData;
-        } else {
-          bufferToWrite = Buffer.from(fileData.fileData);
+        // 受信済みの一時ファイルを移動する（別ドライブの場合はコピー）
+        try {
+          fs.renameSync(tempPath, result.filePath);
+        } catch {
+          fs.copyFileSync(tempPath, result.filePath);
+          fs.rmSync(tempPath, { force: true });
         }
-
-        fs.writeFileSync(result.filePath, bufferToWrite);
         return { success: true, path: result.filePath };
       }
 
+      fs.rmSync(tempPath, { force: true });
       return { success: false };
     } catch (error) {
+      fs.rmSync(tempPath, { force: true });
       throw error;
     }
   },
@@ -211,6 +270,8 @@ function loadClientConfig(): ServerConfig {
       server_address: config.server_address,
       server_port: config.server_port,
       stream_rate: config.stream_rate,
+      // 古いサーバーに接続する場合は "rsa" を指定する
+      handshake: config.handshake || "x25519",
     };
   } catch (error) {
     throw error;
@@ -332,160 +393,621 @@ async function exchangePublicKeys(
   }
 }
 
-function sendFileData(
+// X25519鍵交換を行い、HKDFで導出したAES鍵を返す
+async function performX25519Handshake(socket: net.Socket, keyPaths: KeyPaths): Promise<Buffer> {
+  const { publicKey, privateKey } = generateKeyPairSync("x25519");
+  const clientX25519Public = Buffer.from(publicKey.export({ format: "jwk" }).x!, "base64url");
+
+  // バージョン(1B) + X25519公開鍵(32B) + クライアントの公開鍵(PEM、サーバー側でクライアントの識別に使用)
+  const hello = Buffer.concat([Buffer.from([HANDSHAKE_X25519]), clientX25519Public, fs.readFileSync(keyPaths.clientPublicPath)]);
+  const sizeBuffer = Buffer.alloc(4);
+  sizeBuffer.writeUInt32BE(hello.length, 0);
+  socket.write(Buffer.concat([sizeBuffer, hello]));
+
+  const reply = await receivePublicKeyInfo(socket);
+  if (reply.length !== 33 || reply.readUInt8(0) !== HANDSHAKE_X25519) {
+    throw new Error("サーバーがX25519ハンドシェイクに対応していません");
+  }
+  const serverX25519Public = reply.subarray(1);
+
+  // 両方のX25519公開鍵に署名し、クライアントの秘密鍵を持っていることをサーバーに証明する
+  const privateKeyPem = safeStorage.decryptString(fs.readFileSync(keyPaths.securePrivatePath));
+  const signature = sign("sha256", Buffer.concat([HANDSHAKE_SIGNATURE_INFO, clientX25519Public, serverX25519Public]), {
+    key: privateKeyPem,
+    padding: constants.RSA_PKCS1_PSS_PADDING,
+    saltLength: 32,
+  });
+  const signatureSize = Buffer.alloc(4);
+  signatureSize.writeUInt32BE(signature.length, 0);
+  socket.write(Buffer.concat([signatureSize, signature]));
+
+  const sharedSecret = diffieHellman({
+    privateKey,
+    publicKey: createPublicKey({
+      key: { kty: "OKP", crv: "X25519", x: serverX25519Public.toString("base64url") },
+      format: "jwk",
+    }),
+  });
+  const info = Buffer.concat([HANDSHAKE_INFO, clientX25519Public, serverX25519Public]);
+  return Buffer.from(hkdfSync("sha256", sharedSecret, Buffer.alloc(0), info, 32));
+}
+
+// サーバーから「4Bサイズ + 暗号化ステータス」「4Bサイズ + 暗号化JSON」の1メッセージを受信
+function receiveEncryptedMessage(socket: net.Socket, clientAesKey: Buffer): Promise<EncryptedMessage> {
+  return new Promise((resolve, reject) => {
+    let buffer = Buffer.alloc(0);
+
+    const cleanup = () => {
+      clearTimeout(timer);
+      // 次の読み手がリスナーを登録するまでデータを取りこぼさないよう一時停止
+      socket.pause();
+      socket.off("data", onData);
+      socket.off("error", onError);
+      socket.off("close", onClose);
+    };
+
+    const readFrame = (offset: number): Buffer | null => {
+      if (buffer.length < offset + 4) return null;
+      const size = buffer.readUInt32BE(offset);
+      if (buffer.length < offset + 4 + size) return null;
+      return buffer.subarray(offset + 4, offset + 4 + size);
+    };
+
+    const onData = (chunk: Buffer) => {
+      buffer = Buffer.concat([buffer, chunk]);
+
+      const encryptedHeader = readFrame(0);
+      if (encryptedHeader === null) return;
+      const encryptedJson = readFrame(4 + encryptedHeader.length);
+      if (encryptedJson === null) return;
+
+      cleanup();
+      try {
+        const consumed = 8 + encryptedHeader.length + encryptedJson.length;
+        // このメッセージ以降に届いたデータは次の読み手のために戻す
+        if (buffer.length > consumed) {
+          socket.unshift(buffer.subarray(consumed));
+        }
+        const code = decryptChunk(encryptedHeader, clientAesKey).readUInt8(0);
+        const json = JSON.parse(decryptChunk(encryptedJson, clientAesKey).toString("utf-8"));
+        resolve({ code, json });
+      } catch (error) {
+        reject(error);
+      }
+    };
+
+    const onError = (err: Error) => {
+      cleanup();
+      reject(err);
+    };
+
+    const onClose = () => {
+      cleanup();
+      reject(new ConnectionLostError("Connection closed before the server responded"));
+    };
+
+    socket.on("data", onData);
+    socket.on("error", onError);
+    socket.on("close", onClose);
+    socket.resume();
+
+    const timer = setTimeout(() => {
+      cleanup();
+      reject(new Error("Read timeout"));
+    }, 30000);
+  });
+}
+
+// クライアントからサーバーへの制御メッセージ（4Bサイズ + 暗号化JSON）
+function sendEncryptedMessage(socket: net.Socket, message: any, clientAesKey: Buffer): void {
+  const encrypted = encryptChunk(Buffer.from(JSON.stringify(message), "utf8"), clientAesKey);
+  const sizeBuffer = Buffer.alloc(4);
+  sizeBuffer.writeUInt32BE(encrypted.length, 0);
+  socket.write(Buffer.concat([sizeBuffer, encrypted]));
+}
+
+// プレビューを受信する。プレビュー以外のレスポンスが届いた場合はソケットに戻して null を返す
+function receivePreview(socket: net.Socket, clientAesKey: Buffer): Promise<{ fileExtension: string; fileData: Buffer } | null> {
+  return new Promise((resolve, reject) => {
+    // 届いたデータは一度だけ取り込み、揃ったフレームから順に復号する
+    const ring = new RingBuffer(1024 * 1024);
+    let responseCode: number | null = null;
+    let jsonData: any = null;
+    const dataFrames: Buffer[] = [];
+    let totalDecryptedSize = 0;
+
+    const cleanup = (rest: Buffer) => {
+      socket.pause();
+      socket.off("data", onData);
+      socket.off("error", onError);
+      socket.off("close", onClose);
+      // 続くレスポンスのデータは receiveResponse が読めるようにソケットに戻す
+      if (rest.length > 0) {
+        socket.unshift(rest);
+      }
+    };
+
+    const onData = (chunk: Buffer) => {
+      ring.write(chunk);
+
+      try {
+        if (responseCode === null) {
+          const header = ring.readFrame();
+          if (header === null) return;
+          responseCode = decryptChunk(header, clientAesKey).readUInt8(0);
+          if (responseCode !== RESPONSE_PREVIEW) {
+            // プレビューを作成できなかった場合は最終レスポンスが直接届く
+            const sizeBuffer = Buffer.alloc(4);
+            sizeBuffer.writeUInt32BE(header.length, 0);
+            cleanup(Buffer.concat([sizeBuffer, header, ring.read(ring.length)]));
+            resolve(null);
+            return;
+          }
+        }
+        if (jsonData === null) {
+          const json = ring.readFrame();
+          if (json === null) return;
+          jsonData = JSON.parse(decryptChunk(json, clientAesKey).toString("utf-8"));
+        }
+
+        let frame: Buffer | null;
+        while (totalDecryptedSize < jsonData.file_size && (frame = ring.readFrame()) !== null) {
+          const data = decryptChunk(frame, clientAesKey);
+          dataFrames.push(data);
+          totalDecryptedSize += data.length;
+        }
+        if (totalDecryptedSize < jsonData.file_size) return;
+
+        cleanup(ring.read(ring.length));
+        resolve({ fileExtension: jsonData.file_extension, fileData: Buffer.concat(dataFrames) });
+      } catch (error) {
+        cleanup(Buffer.alloc(0));
+        reject(error);
+      }
+    };
+
+    const onError = (err: Error) => {
+      cleanup(Buffer.alloc(0));
+      reject(err);
+    };
+
+    const onClose = () => {
+      cleanup(Buffer.alloc(0));
+      reject(new ConnectionLostError("Connection closed before the preview was received"));
+    };
+
+    socket.on("data", onData);
+    socket.on("error", onError);
+    socket.on("close", onClose);
+    socket.resume();
+  });
+}
+
+// プレビューを表示し、本処理を続けるかをユーザーに確認してサーバーに伝える
+async function handlePreview(socket: net.Socket, clientAesKey: Buffer): Promise<void> {
+  const preview = await receivePreview(socket, clientAesKey);
+  if (preview === null) {
+    return;
+  }
+
+  const previewPath = path.join(app.getPath("temp"), `preview_${Date.now()}.${preview.fileExtension}`);
+  fs.writeFileSync(previewPath, preview.fileData);
+  await shell.openPath(previewPath);
+
+  const window = BrowserWindow.getAllWindows()[0];
+  const options = {
+    type: "question" as const,
+    buttons: ["Continue", "Cancel"],
+    defaultId: 0,
+    cancelId: 1,
+    message: "Check the preview. Continue with the full conversion?",
+  };
+  const result = window ? await dialog.showMessageBox(window, options) : await dialog.showMessageBox(options);
+
+  fs.rmSync(previewPath, { force: true });
+  sendEncryptedMessage(socket, { continue: result.response === 0 }, clientAesKey);
+}
+
+// 順番待ちの状況をレンダラーに送る（null は順番が来たことを表す）
+function sendQueueStatus(status: { queuePosition: number; estimatedWaitSeconds: number } | null): void {
+  const window = BrowserWindow.getAllWindows()[0];
+  if (window) {
+    window.webContents.send("queue-status", status);
+  }
+}
+
+// ファイルのSHA-256を計算する。サーバーが同じファイルを保持していればアップロードが省略される
+function computeFileHash(filePath: string): Promise<string> {
+  return new Promise((resolve, reject) => {
+    const hash = createHash("sha256");
+    fs.createReadStream(filePath)
+      .on("data", (chunk) => hash.update(chunk))
+      .on("end", () => resolve(hash.digest("hex")))
+      .on("error", reject);
+  });
+}
+
+// ヘッダ送信後、サーバーから返されたオフセット以降のファイルデータを送信し、アップロードIDを返す
+async function sendFileData(
   socket: net.Socket,
   filePath: string,
   requestParams: ProcessingParams,
   config: ServerConfig,
   clientAesKey: Buffer,
-): Promise<void> {
+  onUploadReady: (uploadId: string | null) => void,
+): Promise<string | null> {
+  const mediatype = path.extname(filePath).substring(1);
+  const stats = fs.statSync(filePath);
+  const fileSize = stats.size;
+
+  const reqParamsJson = JSON.stringify(requestParams);
+  const reqParamsSize = Buffer.byteLength(reqParamsJson, "utf8");
+  const mediatypeSize = Buffer.byteLength(mediatype, "utf8");
+
+  const header = createRequestHeader(
+    reqParamsSize,
+    mediatypeSize,
+    fileSize,
+  );
+
+  socket.write(encryptChunk(Buffer.from(header), clientAesKey));
+  socket.write(encryptChunk(Buffer.from(reqParamsJson, "utf8"), clientAesKey));
+  socket.write(encryptChunk(Buffer.from(mediatype, "utf8"), clientAesKey));
+
+  // サーバーが混雑している間は、順番待ちの状況が届くので画面に表示する
+  let ready = await receiveEncryptedMessage(socket, clientAesKey);
+  const queued = ready.code === RESPONSE_QUEUED;
+  while (ready.code === RESPONSE_QUEUED) {
+    sendQueueStatus({ queuePosition: ready.json.queue_position, estimatedWaitSeconds: ready.json.estimated_wait_seconds });
+    ready = await receiveEncryptedMessage(socket, clientAesKey);
+  }
+  if (queued) {
+    sendQueueStatus(null);
+  }
+  if (ready.code === RESPONSE_ERROR) {
+    throw new ServerRejectedError(`${ready.json.description} ${ready.json.solution}`, ready.json.retry_after ?? null);
+  }
+  if (ready.code !== RESPONSE_UPLOAD_READY) {
+    throw new Error(`Unexpected response code: ${ready.code}`);
+  }
+
+  const uploadId: string | null = ready.json.upload_id;
+  const offset: number = ready.json.offset;
+  // アップロード中に切断されても再開できるよう、IDはすぐに呼び出し元へ渡す
+  onUploadReady(uploadId);
+  if (uploadId === null && offset >= fileSize) {
+    console.log("サーバーに同じファイルがあるため、アップロードを省略");
+  } else if (offset > 0) {
+    console.log(`アップロードを ${offset} バイト目から再開`);
+  }
+
+  if (offset >= fileSize) {
+    return uploadId;
+  }
+
   return new Promise((resolve, reject) => {
-    try {
-      const mediatype = path.extname(filePath).substring(1);
-      const stats = fs.statSync(filePath);
-      const fileSize = stats.size;
-
-      const reqParamsJson = JSON.stringify(requestParams);
-      const reqParamsSize = Buffer.byteLength(reqParamsJson, "utf8");
-      const mediatypeSize = Buffer.byteLength(mediatype, "utf8");
-
-      const header = createRequestHeader(
-        reqParamsSize,
-        mediatypeSize,
-        fileSize,
-      );
-
-      socket.write(encryptChunk(Buffer.from(header), clientAesKey));
-      socket.write(encryptChunk(Buffer.from(reqParamsJson, "utf8"), clientAesKey));
-      socket.write(encryptChunk(Buffer.from(mediatype, "utf8"), clientAesKey));
-
-      const fileStream = fs.createReadStream(filePath, {
-        highWaterMark: config.stream_rate,
-      });
+    const fileStream = fs.createReadStream(filePath, {
+      highWaterMark: config.stream_rate,
+      start: offset,
+    });
 
-      fileStream.on("data", (chunk: Buffer | string) => {
-        const buf = Buffer.isBuffer(chunk) ? chunk : Buffer.from(chunk, "utf8");
-        socket.write(encryptChunk(buf, clientAesKey));
-      });
+    const cleanup = () => {
+      socket.off("error", onSocketError);
+      socket.off("close", onSocketClose);
+      socket.off("drain", onDrain);
+    };
 
-      fileStream.on("end", () => {
-        resolve();
-      });
+    const onSocketError = (error: Error) => {
+      cleanup();
+      fileStream.destroy();
+      reject(new ConnectionLostError(`Upload interrupted: ${error.message}`));
+    };
 
-      fileStream.on("error", (error) => {
-        reject(error);
-      });
-    } catch (error) {
+    const onSocketClose = () => onSocketError(new Error("connection closed"));
+
+    const onDrain = () => fileStream.resume();
+
+    socket.on("error", onSocketError);
+    socket.on("close", onSocketClose);
+    socket.on("drain", onDrain);
+
+    fileStream.on("data", (chunk: Buffer | string) => {
+      const buf = Buffer.isBuffer(chunk) ? chunk : Buffer.from(chunk, "utf8");
+      // 送信バッファが溢れたら、吐き出されるまでファイルの読み込みを止める
+      if (!socket.write(encryptChunk(buf, clientAesKey))) {
+        fileStream.pause();
+      }
+    });
+
+    fileStream.on("end", () => {
+      cleanup();
+      resolve(uploadId);
+    });
+
+    fileStream.on("error", (error) => {
+      cleanup();
       reject(error);
-    }
+    });
   });
 }
 
-function receiveResponse(socket: net.Socket, clientAesKey: Buffer): Promise<any> {
+// 受信データを固定サイズの領域に循環して保持し、フレーム単位で取り出すリングバッファ
+class RingBuffer {
+  private buffer: Buffer;
+  private readOffset = 0;
+  length = 0;
+
+  constructor(capacity: number) {
+    this.buffer = Buffer.alloc(capacity);
+  }
+
+  write(chunk: Buffer): void {
+    // 1フレームが容量を超える場合のみ拡張する
+    if (this.length + chunk.length > this.buffer.length) {
+      const grown = Buffer.alloc(Math.max(this.buffer.length * 2, this.length + chunk.length));
+      this.copyOut(grown, this.length);
+      this.buffer = grown;
+      this.readOffset = 0;
+    }
+    const writeOffset = (this.readOffset + this.length) % this.buffer.length;
+    const firstPart = Math.min(chunk.length, this.buffer.length - writeOffset);
+    chunk.copy(this.buffer, writeOffset, 0, firstPart);
+    chunk.copy(this.buffer, 0, firstPart);
+    this.length += chunk.length;
+  }
+
+  peekUInt32BE(): number {
+    const header = Buffer.alloc(4);
+    this.copyOut(header, 4);
+    return header.readUInt32BE(0);
+  }
+
+  // サイズ（4B）付きのフレームが揃っていれば本体を取り出し、揃っていなければ null を返す
+  readFrame(): Buffer | null {
+    if (this.length < 4) return null;
+    const size = this.peekUInt32BE();
+    if (this.length < 4 + size) return null;
+    this.read(4);
+    return this.read(size);
+  }
+
+  read(size: number): Buffer {
+    const data = Buffer.alloc(size);
+    this.copyOut(data, size);
+    this.readOffset = (this.readOffset + size) % this.buffer.length;
+    this.length -= size;
+    return data;
+  }
+
+  private copyOut(target: Buffer, size: number): void {
+    const firstPart = Math.min(size, this.buffer.length - this.readOffset);
+    this.buffer.copy(target, 0, this.readOffset, this.readOffset + firstPart);
+    this.buffer.copy(target, firstPart, 0, size - firstPart);
+  }
+}
+
+// レスポンスをフレームごとに復号してファイルへ書き込む（メモリ使用量はファイルサイズに依存しない）
+function receiveResponse(socket: net.Socket, clientAesKey: Buffer, outputPath: string): Promise<any> {
   return new Promise((resolve, reject) => {
-    const chunks: Buffer[] = [];
+    const ring = new RingBuffer(1024 * 1024);
+    let responseCode: number | null = null;
+    let jsonData: any = null;
+    let fileStream: fs.WriteStream | null = null;
+    let totalDecryptedSize = 0;
+    let finished = false;
+
+    const cleanup = () => {
+      finished = true;
+      socket.off("data", onData);
+      socket.off("error", onError);
+      socket.off("close", onClose);
+    };
 
-    socket.on("data", (chunk: Buffer) => {
-      chunks.push(chunk);
-    });
+    const fail = (error: Error) => {
+      if (finished) return;
+      cleanup();
+      if (fileStream) {
+        fileStream.destroy();
+        fs.rmSync(outputPath, { force: true });
+      }
+      reject(error);
+    };
+
+    const nextFrame = (): Buffer | null => {
+      const frame = ring.readFrame();
+      return frame === null ? null : decryptChunk(frame, clientAesKey);
+    };
+
+    const complete = () => {
+      cleanup();
+      fileStream!.end(() => {
+        resolve({
+          status: "success",
+          filePath: outputPath,
+          fileExtension: jsonData.file_extension,
+        });
+      });
+    };
+
+    const onData = (chunk: Buffer) => {
+      ring.write(chunk);
 
-    socket.on("end", () => {
       try {
-        const buffer = Buffer.concat(chunks);
-        let offset = 0;
-        
-        const encryptedHeaderSize = buffer.readUInt32BE(offset);
-        offset += 4;
-        const encryptedHeader = buffer.subarray(offset, offset + encryptedHeaderSize);
-        offset += encryptedHeaderSize;
-        const decryptedHeader = decryptChunk(encryptedHeader, clientAesKey);
-        const responseCode = decryptedHeader.readUInt8(0);
-
-        const encryptedJsonSize = buffer.readUInt32BE(offset);
-        offset += 4;
-        const encryptedJson = buffer.subarray(offset, offset + encryptedJsonSize);
-        offset += encryptedJsonSize;
-        const decryptedJson = decryptChunk(encryptedJson, clientAesKey);
-        const jsonData = JSON.parse(decryptedJson.toString('utf-8'));
-
-        if (responseCode === 0x00) {
-          resolve({ status: "error", error: jsonData });
-        } else {
-          const decryptedFileChunks: Buffer[] = [];
-          let totalDecryptedSize = 0;
-          
-          while (offset < buffer.length && totalDecryptedSize < jsonData.file_size) {
-            if (offset + 4 > buffer.length) break;
-            
-            const encryptedChunkSize = buffer.readUInt32BE(offset);
-            offset += 4;
-            
-            if (offset + encryptedChunkSize > buffer.length) break;
-            
-            const encryptedChunk = buffer.subarray(offset, offset + encryptedChunkSize);
-            offset += encryptedChunkSize;
-            
-            const decryptedChunk = decryptChunk(encryptedChunk, clientAesKey);
-            decryptedFileChunks.push(decryptedChunk);
-            totalDecryptedSize += decryptedChunk.length;
+        if (responseCode === null) {
+          const header = nextFrame();
+          if (header === null) return;
+          responseCode = header.readUInt8(0);
+        }
+        if (jsonData === null) {
+          const json = nextFrame();
+          if (json === null) return;
+          jsonData = JSON.parse(json.toString("utf-8"));
+
+          if (responseCode === RESPONSE_ERROR) {
+            cleanup();
+            resolve({ status: "error", error: jsonData });
+            return;
           }
+          fileStream = fs.createWriteStream(outputPath);
+          fileStream.on("error", fail);
+          fileStream.on("drain", () => socket.resume());
+        }
 
-          const finalFileData = Buffer.concat(decryptedFileChunks);
+        let frame: Buffer | null;
+        while (totalDecryptedSize < jsonData.file_size && (frame = nextFrame()) !== null) {
+          totalDecryptedSize += frame.length;
+          // 書き込みが追いつかない場合は、ディスクに書き終わるまで受信を止める
+          if (!fileStream!.write(frame)) {
+            socket.pause();
+          }
+        }
 
-          resolve({
-            status: "success",
-            filename: `output.${jsonData.file_extension}`,
-            fileData: Array.from(finalFileData),
-            fileExtension: jsonData.file_extension,
-          });
+        if (totalDecryptedSize >= jsonData.file_size) {
+          complete();
         }
       } catch (error) {
-        reject(error);
+        fail(error as Error);
       }
-    });
+    };
+
+    const onError = (err: Error) => fail(err);
+
+    const onClose = () => {
+      // 結果のヘッダを受け取る前の切断は、アップロードの中断として再試行できる
+      const message = "Connection closed before the response was received";
+      fail(responseCode === null ? new ConnectionLostError(message) : new Error(message));
+    };
 
-    socket.on("error", reject);
+    socket.on("data", onData);
+    socket.on("error", onError);
+    socket.on("close", onClose);
+    socket.resume();
   });
 }
 
+// 接続・鍵交換・アップロードまでを行い、レスポンス待ちのソケットを返す
+async function connectAndUpload(
+  request: ProcessingRequest,
+  config: ServerConfig,
+  uploadId: string | null,
+  contentHash: string | null,
+  onUploadReady: (uploadId: string | null) => void,
+): Promise<{ socket: net.Socket; clientAesKey: Buffer; uploadId: string | null }> {
+  const socket = await connectToServer(config);
+
+  try {
+    const keyPaths = getKeyPaths();
+
+    let clientAesKey: Buffer;
+    if (config.handshake === "rsa") {
+      const serverKey = await exchangePublicKeys(socket, keyPaths.clientPublicPath);
+
+      clientAesKey = generateAESKey();
+      const encryptedAesKey = encryptAESWithRSA(clientAesKey, serverKey);
+
+      await sendEncryptedAESKey(encryptedAesKey, socket);
+    } else {
+      clientAesKey = await performX25519Handshake(socket, keyPaths);
+    }
+
+    const requestParams: ProcessingParams = {
+      ...request.requestParams,
+      protocol_version: PROTOCOL_VERSION,
+      upload_id: uploadId,
+      content_hash: contentHash ?? undefined,
+    };
+
+    const confirmedUploadId = await sendFileData(socket, request.filePath, requestParams, config, clientAesKey, onUploadReady);
+
+    return { socket, clientAesKey, uploadId: confirmedUploadId };
+  } catch (error) {
+    socket.destroy();
+    throw error;
+  }
+}
+
 async function processVideoRequest(request: ProcessingRequest): Promise<any> {
   const config = loadClientConfig();
 
   let socket: net.Socket | null = null;
+  let uploadId: string | null = null;
+  // 結果はメモリに保持せず一時ファイルに書き込み、保存時に移動する
+  const outputPath = path.join(app.getPath("temp"), `output_${Date.now()}`);
+  cancelRequested = false;
 
   try {
-    socket = await connectToServer(config);
-
-    const { clientPublicPath } = getKeyPaths();
+    let response: any = null;
+    // サーバーはX25519で鍵を検証したクライアントのファイルしか再利用しないため、RSAでは計算しない
+    const contentHash = config.handshake === "rsa" ? null : await computeFileHash(request.filePath);
 
-    const serverKey = await exchangePublicKeys(socket, clientPublicPath);
-
-    const clientAesKey = generateAESKey();
-    const encryptedAesKey = encryptAESWithRSA(clientAesKey, serverKey);
+    // 通信が途切れた場合は、サーバーが記録した位置からアップロードを再開する
+    for (let attempt = 0; ; attempt++) {
+      let uploaded = false;
+      try {
+        const session = await connectAndUpload(request, config, uploadId, contentHash, (id) => {
+          uploadId = id;
+        });
+        uploaded = true;
+        socket = session.socket;
+        const clientAesKey = session.clientAesKey;
+        // 変換中はデータが流れないため、無通信タイムアウトを解除する（切断するとサーバーは処理を中止する）
+        socket.setTimeout(0);
+        activeSession = { socket, clientAesKey };
+        if (cancelRequested) {
+          sendEncryptedMessage(socket, { cancel: true }, clientAesKey);
+        }
 
-    await sendEncryptedAESKey(encryptedAesKey, socket);
+        if (request.requestParams.preview) {
+          await handlePreview(socket, clientAesKey);
+        }
 
-    await sendFileData(socket, request.filePath, request.requestParams, config, clientAesKey);
+        response = await receiveResponse(socket, clientAesKey, outputPath);
+      } catch (error) {
+        // アップロード中、または結果のヘッダを受け取る前の切断は再試行する
+        const retryable = !(error instanceof ServerRejectedError) && (!uploaded || error instanceof ConnectionLostError);
+        if (!retryable || attempt >= UPLOAD_RETRY_LIMIT || cancelRequested) {
+          throw error;
+        }
+        activeSession = null;
+        if (socket) {
+          socket.destroy();
+          socket = null;
+        }
+        console.log(`アップロードを再試行します (${attempt + 1}/${UPLOAD_RETRY_LIMIT}):`, error);
+        await new Promise((resolve) => setTimeout(resolve, UPLOAD_RETRY_DELAY_MS));
+        continue;
+      }
 
-    const response = await receiveResponse(socket, clientAesKey);
+      // サーバー側でアップロードが中断された場合も、同じアップロードIDで再開する
+      if (response.status === "error" && response.error.upload_id && attempt < UPLOAD_RETRY_LIMIT) {
+        uploadId = response.error.upload_id;
+        socket.destroy();
+        socket = null;
+        continue;
+      }
+      break;
+    }
 
     if (response.status === "error") {
-      throw new Error(response.error);
+      throw new Error(response.error.description);
     }
 
     const userFileName = request.requestParams.outputFileName || "output";
     const finalFileName = `${userFileName}.${response.fileExtension}`;
+    const resultId = randomUUID();
+    pendingResults.set(resultId, response.filePath);
 
     return {
       status: "success",
       message: "Video processing completed successfully!",
       filename: finalFileName,
       fileExtension: response.fileExtension,
-      fileData: Array.from(response.fileData),
+      resultId,
     };
   } catch (error) {
     throw error;
   } finally {
+    activeSession = null;
     if (socket) {
       socket.destroy();
     }
@@ -497,6 +1019,13 @@ app.whenReady().then(() => {
   createWindow();
 });
 
+app.on("will-quit", () => {
+  // 保存されなかった結果の一時ファイルを削除する
+  for (const tempPath of pendingResults.values()) {
+    fs.rmSync(tempPath, { force: true });
+  }
+});
+
 app.on("window-all-closed", () => {
   if (process.platform !== "darwin") app.quit();
 });
@@ -5,11 +5,18 @@ interface FileStats {
   isFile: boolean;
 }
 
+interface QueueStatus {
+  queuePosition: number;
+  estimatedWaitSeconds: number;
+}
+
 interface ElectronAPI {
   openVideoDialog: () => Promise<string | any>;
   getFileStats: (filePath: string) => Promise<FileStats | any>;
   processVideo: (filePath: string, params: any) => Promise<any>;
   downloadFile: (fileData: any) => Promise<any>;
+  cancelProcessing: () => Promise<void>;
+  onQueueStatus: (callback: (status: QueueStatus | null) => void) => void;
 }
 
 contextBridge.exposeInMainWorld("electronAPI", {
@@ -36,4 +43,8 @@ contextBridge.exposeInMainWorld("electronAPI", {
       throw error;
     }
   },
+  cancelProcessing: () => ipcRenderer.invoke("cancel-video-request"),
+  onQueueStatus: (callback: (status: QueueStatus | null) => void) => {
+    ipcRenderer.on("queue-status", (event, status) => callback(status));
+  },
 } as ElectronAPI);
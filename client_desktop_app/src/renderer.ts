@@ -6,6 +6,7 @@ interface ProcessingParams {
   endseconds?: number;
   extension?: string;
   outputFileName?: string;
+  preview?: boolean;
 }
 
 interface SelectedFile {
@@ -19,6 +20,8 @@ class VideoProcessorUI {
   private selectedOperation: string | null = null;
   private processingParams: ProcessingParams | null = null;
   private progressInterval: NodeJS.Timeout | null = null;
+  // Shown instead of the progress while the server queues the request
+  private queueStatusText: string | null = null;
 
   constructor() {
     this.initializeEventListeners();
@@ -32,6 +35,20 @@ class VideoProcessorUI {
 
     // Handle execution after selecting operation mode and showing settings
     this.setupExecuteButton();
+    this.setupCancelButton();
+    this.setupQueueStatus();
+  }
+
+  private setupQueueStatus(): void {
+    (window as any).electronAPI.onQueueStatus((status: { queuePosition: number; estimatedWaitSeconds: number } | null) => {
+      this.queueStatusText = status === null
+        ? null
+        : `Waiting for the server: position ${status.queuePosition} in the queue, about ${status.estimatedWaitSeconds} seconds`;
+      if (this.queueStatusText !== null) {
+        const progressText = document.getElementById("progressText") as HTMLElement;
+        progressText.textContent = this.queueStatusText;
+      }
+    });
   }
 
   private async setupFileUpload(): Promise<void> {
@@ -201,6 +218,17 @@ class VideoProcessorUI {
     });
   }
 
+  private setupCancelButton(): void {
+    const cancelBtn = document.getElementById("cancelBtn") as HTMLButtonElement;
+
+    cancelBtn.addEventListener("click", async () => {
+      // The server stops FFmpeg and answers with an error, which resets the UI
+      const progressText = document.getElementById("progressText") as HTMLElement;
+      progressText.textContent = "Cancelling...";
+      await (window as any).electronAPI.cancelProcessing();
+    });
+  }
+
   // Used in setupExecuteButton
   private collectProcessingParams(): ProcessingParams | null {
     const action = this.getActionNumber(this.selectedOperation!);
@@ -267,6 +295,11 @@ class VideoProcessorUI {
 
     params.outputFileName = outputFileName;
 
+    const previewCheckbox = document.getElementById(
+      "previewFirst",
+    ) as HTMLInputElement;
+    params.preview = previewCheckbox.checked;
+
     return params;
   }
 
@@ -320,6 +353,10 @@ class VideoProcessorUI {
       progress += Math.random() * 10;
       if (progress > 90) progress = 90;
 
+      if (this.queueStatusText !== null) {
+        progressText.textContent = this.queueStatusText;
+        return;
+      }
       progressFill.style.width = `${progress}%`;
       progressText.textContent = `Processing... ${Math.round(progress)}%`;
     }, 500);
@@ -342,7 +379,7 @@ class VideoProcessorUI {
     try {
       const downloadResult = await (window as any).electronAPI.downloadFile({
         filename: result.filename,
-        fileData: result.fileData,
+        resultId: result.resultId,
         fileExtension: result.fileExtension,
       });
 
@@ -364,6 +401,7 @@ class VideoProcessorUI {
     if (this.progressInterval) {
       clearInterval(this.progressInterval);
     }
+    this.queueStatusText = null;
 
     console.error("Processing error:", error);
     alert(`An error occurred during processing: ${error.message || error}`);
@@ -2,11 +2,25 @@ import socket
 import os
 import json
 import uuid
+import time
+import sqlite3
+import threading
+import shutil
+import stat
 import subprocess
+import argparse
+import hashlib
+import hmac
+import select
+from contextlib import closing
+from collections import OrderedDict, deque
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
+from cryptography.exceptions import InvalidSignature
 
 class SuccessInfo:
     def __init__(self, filepath, file_size) -> None:
@@ -28,47 +42,144 @@ class SuccessInfo:
         return json.dumps(self.to_dict(), ensure_ascii=False)
 
 class ErrorInfo:
-    def __init__(self, code, description, solution) -> None:
+    def __init__(self, code, description, solution, upload_id=None, retry_after=None) -> None:
         self.error_code = code
         self.description = description
         self.solution = solution
+        # Set when a resumable upload failed, so the client knows which upload to continue
+        self.upload_id = upload_id
+        # Set when the server is saturated, in seconds until a retry is likely to be admitted
+        self.retry_after = retry_after
 
     def to_dict(self):
-        return {
+        error_dict = {
             'error_code': self.error_code,
             'description': self.description,
             'solution': self.solution
         }
+        if self.upload_id is not None:
+            error_dict['upload_id'] = self.upload_id
+        if self.retry_after is not None:
+            error_dict['retry_after'] = self.retry_after
+        return error_dict
 
     def to_json(self):
         return json.dumps(self.to_dict(), ensure_ascii=False)
 
+# Status codes carried in the first byte of every encrypted response header
+RESPONSE_ERROR = b'\x00'
+RESPONSE_SUCCESS = b'\x01'
+RESPONSE_UPLOAD_READY = b'\x02'
+RESPONSE_JOB_STATUS = b'\x03'
+RESPONSE_QUEUED = b'\x04'
+RESPONSE_PREVIEW = b'\x05'
+# Largest encrypted control frame ({"continue": ...}, {"cancel": true}) accepted from a client
+MAX_CONTROL_FRAME_SIZE = 4096
+
 # Connection-related functions implementation starts here
 def create_server_socket(config):
     # Address family: socket.AF_INET, Communication type: SOCK_STREAM = TCP communication (reliable, ordered, connection-oriented)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((config['server_address'], config['server_port']))
-    sock.listen(1)
+    sock.listen(16)
     print('Server started. Waiting for client connections.')
     return sock
 
 # Request-related functions implementation starts here
+# Handshake version byte of clients using ephemeral X25519 key agreement. Older clients start with an RSA public key in PEM format ('-')
+HANDSHAKE_X25519 = 0x02
+HANDSHAKE_INFO = b'video_compressor x25519 handshake'
+HANDSHAKE_SIGNATURE_INFO = b'video_compressor client signature'
+# Handshake messages are read before the client is authenticated, so their sizes are capped
+MAX_HELLO_SIZE = 16384
+MAX_SIGNATURE_SIZE = 1024
+MAX_ENCRYPTED_KEY_SIZE = 1024
+
 def initialize_rsa():
+    global global_rsa_manager, global_rsa_lock
+    # The RSA key pair is only needed by RSA clients, so it is generated on the first RSA handshake
+    global_rsa_manager = None
+    global_rsa_lock = threading.Lock()
+
+def get_rsa_manager():
     global global_rsa_manager
-    global_rsa_manager = RSAManager()
-    print("RSA keys generated")
+    with global_rsa_lock:
+        if global_rsa_manager is None:
+            global_rsa_manager = RSAManager()
+            print("RSA keys generated")
+        return global_rsa_manager
+
+def perform_handshake(connection):
+    """Establishes the AES session key with either handshake, chosen by the first message of the client.
+    Returns (aes_key, client public key or None). The key is only returned when the client proved it holds the private key."""
+    hello_length = int.from_bytes(receive_exact(connection, 4), 'big')
+    if hello_length > MAX_HELLO_SIZE:
+        raise Exception("Client hello is too large")
+    hello = receive_exact(connection, hello_length)
+
+    if hello[:1] == bytes([HANDSHAKE_X25519]):
+        return exchange_x25519_keys(connection, hello)
+
+    # RSA clients do not prove possession of their key, so they are not identified by it
+    exchange_public_keys(connection, hello)
+    return receive_encrypted_aes_key(connection), None
+
+def exchange_x25519_keys(connection, hello):
+    """Handshake version 2: ephemeral X25519 keys on both sides and an HKDF-derived AES key, which gives forward secrecy.
+    Client hello: version (1 byte), X25519 public key (32 bytes), optionally the client's RSA public key (PEM) as its identity.
+    A client that sent its public key then sends a signature (4-byte size + RSA-PSS SHA-256) over both X25519 public keys."""
+    try:
+        client_x25519_public = hello[1:33]
+        client_public_key = serialization.load_pem_public_key(hello[33:]) if len(hello) > 33 else None
+        if client_public_key is not None and not isinstance(client_public_key, rsa.RSAPublicKey):
+            raise TypeError("Client public key is not in RSA format")
 
-def exchange_public_keys(connection):
+        server_private = X25519PrivateKey.generate()
+        server_x25519_public = server_private.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        reply = bytes([HANDSHAKE_X25519]) + server_x25519_public
+        connection.sendall(len(reply).to_bytes(4, 'big') + reply)
+
+        if client_public_key is not None:
+            # Signing this exchange's keys proves the client holds the private key, so the identity cannot be borrowed or replayed
+            signature_size = int.from_bytes(receive_exact(connection, 4), 'big')
+            if signature_size > MAX_SIGNATURE_SIZE:
+                raise Exception("Client signature is too large")
+            try:
+                client_public_key.verify(
+                    receive_exact(connection, signature_size),
+                    HANDSHAKE_SIGNATURE_INFO + client_x25519_public + server_x25519_public,
+                    padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=32),
+                    hashes.SHA256()
+                )
+            except InvalidSignature:
+                raise Exception("Client signature does not match its public key")
+
+        shared_secret = server_private.exchange(X25519PublicKey.from_public_bytes(client_x25519_public))
+        print("X25519 key exchange completed")
+        return derive_session_key(shared_secret, client_x25519_public, server_x25519_public), client_public_key
+
+    except Exception as e:
+        print(f"X25519 key exchange failed: {e}")
+        raise
+
+def derive_session_key(shared_secret, client_x25519_public, server_x25519_public):
+    # Both public keys are bound into the derivation, so the key belongs to exactly this exchange
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=HANDSHAKE_INFO + client_x25519_public + server_x25519_public
+    ).derive(shared_secret)
+
+def exchange_public_keys(connection, client_public_key_pem):
     try:
-        # Get RSA public key (key length (4 bytes), key)
-        client_public_key_length = int.from_bytes(connection.recv(4), 'big')
-        client_public_key_pem = connection.recv(client_public_key_length).decode('utf-8')
-        client_public_key = serialization.load_pem_public_key(client_public_key_pem.encode())
+        # RSA public key of the client (received as the hello message)
+        client_public_key = serialization.load_pem_public_key(client_public_key_pem)
         print("Client public key loaded successfully")
 
         # Server's PEM format public key for client
-        server_public_key_pem = global_rsa_manager.generatePublicKeyPem()
+        server_public_key_pem = get_rsa_manager().generatePublicKeyPem()
 
         connection.send(len(server_public_key_pem).to_bytes(4, 'big'))
         connection.send(server_public_key_pem)
@@ -86,12 +197,14 @@ def exchange_public_keys(connection):
 
 def receive_encrypted_aes_key(connection):
     try:
-        encrypted_aes_key_size = int.from_bytes(connection.recv(4), 'big')
-        encrypted_aes_key = connection.recv(encrypted_aes_key_size)
+        encrypted_aes_key_size = int.from_bytes(receive_exact(connection, 4), 'big')
+        if encrypted_aes_key_size > MAX_ENCRYPTED_KEY_SIZE:
+            raise Exception("Encrypted AES key is too large")
+        encrypted_aes_key = receive_exact(connection, encrypted_aes_key_size)
         if len(encrypted_aes_key) != encrypted_aes_key_size:
             raise Exception("Received AES key does not meet expected length")
         
-        decrypted_aes_key = global_rsa_manager.decryptContent(encrypted_aes_key)
+        decrypted_aes_key = get_rsa_manager().decryptContent(encrypted_aes_key)
         
         return decrypted_aes_key
     
@@ -145,134 +258,264 @@ def encrypt_chunk(chunk, aes_key):
         raise
 
 
-def handle_client_request(config, connection):
-    client_public_key = exchange_public_keys(connection)
-    aes_key = receive_encrypted_aes_key(connection)
+def handle_client_request(config, connection, client_address):
+    aes_key, client_public_key = perform_handshake(connection)
+    client_id = client_identity(client_public_key, client_address)
+    global_clients.record_connection(client_id)
+    print(f"Client identified as {client_id}")
 
     # AES-encrypted header (36 bytes), decrypted header (8 bytes) containing JSON size (2 bytes), media type (1 byte), file size (5 bytes)
-    encrypted_header = connection.recv(8 + 12 + 16)
+    encrypted_header = receive_exact(connection, 8 + 12 + 16)
     decrypted_header = decrypt_chunk(encrypted_header, aes_key)
     json_size = int.from_bytes(decrypted_header[:2], 'big')
     mediatype_size = int.from_bytes(decrypted_header[2:3], 'big')
     file_size = int.from_bytes(decrypted_header[3:], 'big')
 
+    encrypted_req_params = receive_exact(connection, json_size + 12 + 16)
+    decrypted_req_params = decrypt_chunk(encrypted_req_params, aes_key).decode('utf-8')
+    encrypted_mediatype = receive_exact(connection, mediatype_size + 12 + 16)
+    decrypted_mediatype = decrypt_chunk(encrypted_mediatype, aes_key).decode('utf-8')
+
+    req_data = json.loads(decrypted_req_params)
+
+    # 'sync' processes on this connection, 'submit' queues a job, 'poll' and 'fetch' look up a queued job without uploading
+    mode = req_data.get('mode', 'sync')
+    if mode in ('poll', 'fetch'):
+        return handle_job_request(config, connection, req_data, mode, aes_key, client_id), aes_key
+
     # Treat file size of 0 as an error
     if file_size <= 0:
         raise Exception('Invalid file size')
-    
-    encrypted_req_params = connection.recv(json_size + 12 + 16)
-    decrypted_req_params = decrypt_chunk(encrypted_req_params, aes_key).decode('utf-8')
-    encrypted_mediatype = connection.recv(mediatype_size + 12 + 16)
-    decrypted_mediatype = decrypt_chunk(encrypted_mediatype, aes_key).decode('utf-8')
 
-    filename = f'{uuid.uuid4().hex}.{decrypted_mediatype}'
+    if mode == 'submit':
+        inputfile_path, upload_error = receive_upload(config, connection, req_data, decrypted_mediatype, file_size, aes_key, client_id, durable=True)
+        if upload_error is not None:
+            return upload_error, aes_key
 
-    upload_error = store_uploaded_file_encrypted(config, connection, filename, file_size, aes_key)
+        # Queued jobs are scheduled fairly under the submitting client
+        req_data['client_id'] = client_id
 
-    if upload_error is not None:
-        return upload_error, aes_key
+        job_id = global_job_queue.submit(req_data, inputfile_path)
+        global_job_event.set()
+        print(f"Job {job_id} queued")
+        status_json = json.dumps(global_job_queue.get_status(job_id), ensure_ascii=False)
+        send_encrypted_message(connection, RESPONSE_JOB_STATUS, status_json, aes_key)
+        return None, aes_key
 
-    req_data = json.loads(decrypted_req_params)
+    # Wait for a job slot before the upload, so a saturated server does not receive files it cannot process yet
+    ticket, admission_error = wait_for_admission(config, connection, req_data, aes_key, client_id)
+    if admission_error is not None:
+        return admission_error, aes_key
+
+    try:
+        # A stalled upload must not keep the job slot, so reads time out while it is held
+        connection.settimeout(config['upload_read_timeout'])
+        try:
+            inputfile_path, upload_error = receive_upload(config, connection, req_data, decrypted_mediatype, file_size, aes_key, client_id)
+        finally:
+            connection.settimeout(None)
+        if upload_error is not None:
+            return upload_error, aes_key
+
+        # The job's files are deleted however the request ends, including a connection that breaks while sending
+        output_path = None
+        try:
+            cancelled_after_preview = ErrorInfo('1012', 'The job was cancelled after the preview', 'Adjust the settings and start the conversion again.')
+            previewed = req_data.get('preview') and req_data.get('protocol_version', 1) >= 2
+            if previewed and not send_preview(config, connection, inputfile_path, req_data, aes_key, client_id):
+                return cancelled_after_preview, aes_key
+
+            # The client's {"continue": false} after a preview cancels the full job like a cancel message
+            decision_event = threading.Event()
+            job_started = time.time()
+            output_path, error = execute_job_watched(config, connection, inputfile_path, req_data, aes_key, decision_event)
+            if error is not None:
+                return cancelled_after_preview if previewed and error.error_code == '1014' else error, aes_key
+            global_admission.record_duration(ticket, time.time() - job_started)
+
+            # A job that finished before the client decided waits for the decision, but no longer holds its job slot
+            if previewed and not decision_event.is_set():
+                global_admission.release(ticket)
+                if not receive_preview_decision(config, connection, aes_key):
+                    return cancelled_after_preview, aes_key
+
+            error = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key, client_id=client_id)
+            return error, aes_key
+
+        finally:
+            global_scratch.delete([path for path in (inputfile_path, output_path) if path is not None])
+
+    finally:
+        global_admission.release(ticket)
+
+def receive_upload(config, connection, req_data, mediatype, file_size, aes_key, client_id, durable=False):
+    """Receives the uploaded file into scratch storage and returns (filepath, ErrorInfo | None)"""
+    # Protocol version 2 clients upload resumably: the server answers with an upload ID and the offset to continue from
+    upload_id = None
+    offset = 0
+    content_hash = req_data.get('content_hash')
+    # Stored inputs belong to the client that uploaded them, so only clients that proved their key get deduplication
+    if not is_content_hash(content_hash) or global_input_store is None or not client_id.startswith('key:'):
+        content_hash = None
+
+    if req_data.get('protocol_version', 1) >= 2:
+        # The upload is skipped when the server already stores a file with the same content hash
+        if content_hash is not None:
+            filepath = global_scratch.allocate(f'{uuid.uuid4().hex}.{mediatype}', file_size, durable)
+            if global_input_store.checkout(client_id, content_hash, file_size, filepath):
+                print(f"Input {content_hash} found in the input store. Skipping the upload")
+                ready_json = json.dumps({'upload_id': None, 'offset': file_size})
+                send_encrypted_message(connection, RESPONSE_UPLOAD_READY, ready_json, aes_key)
+                return filepath, None
+            global_scratch.forget(filepath)
+
+        upload_id, filepath, offset = prepare_resumable_upload(config, req_data.get('upload_id'), mediatype, file_size)
+    else:
+        filepath = global_scratch.allocate(f'{uuid.uuid4().hex}.{mediatype}', file_size, durable)
+
+    sha256 = hashlib.sha256() if content_hash is not None else None
+    try:
+        if upload_id is not None:
+            ready_json = json.dumps({'upload_id': upload_id, 'offset': offset})
+            send_encrypted_message(connection, RESPONSE_UPLOAD_READY, ready_json, aes_key)
+        upload_error = store_uploaded_file_encrypted(config, connection, filepath, file_size, aes_key, offset, upload_id, client_id, sha256)
+    finally:
+        if upload_id is not None:
+            finish_resumable_upload(upload_id)
+    # Partial resumable uploads are kept for the next attempt
+    if upload_error is not None and upload_id is None:
+        global_scratch.delete([filepath])
+    if upload_error is None and content_hash is not None:
+        global_input_store.add(client_id, content_hash, sha256.hexdigest(), filepath)
+    # A completed resumable upload no longer needs to survive a reboot, so it may move to the RAM tier
+    if upload_error is None and upload_id is not None and not durable:
+        filepath = global_scratch.promote(filepath)
+    return filepath, upload_error
+
+# Actions whose output can be larger than the input: resolution changes (upscaling), aspect ratio changes and GIF/WEBM clips
+GROWING_ACTIONS = {2, 3, 5}
+
+def run_action(config, input_path, req_data, cancel_event=None):
+    """Runs the FFmpeg processing for the requested action. Returns (output_path, ErrorInfo | None)"""
     action = req_data.get('action', 0)
+    # Outputs are written next to their input, in the same scratch storage tier, unless the action can make them larger
+    filename = os.path.basename(input_path)
+    dir_path = os.path.dirname(input_path)
+    output_dir = global_scratch.output_dir(input_path, action in GROWING_ACTIONS)
+
+    if req_data.get('preview_only'):
+        try:
+            processed_filename, output_path = create_preview(filename, dir_path, req_data, config, cancel_event)
+            print(f'Preview created: {processed_filename}')
+        except Exception as process_err:
+            print(f"Preview error: {str(process_err)}")
+            return None, ErrorInfo('1013', f'Error during preview creation: {str(process_err)}', 'The full conversion can still be run without a preview.')
+        return global_scratch.commit(output_path), None
 
     print(f"Received action: {action}")
 
     match action:
         case 1:
             try:
-                processed_filename, output_path = compress_video(filename, config['dir_path'])
+                processed_filename, output_path = compress_video(filename, dir_path, cancel_event)
                 print(f'Video compression completed: {processed_filename}')
-                error = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
-
-                if error is not None:
-                    return error, aes_key
             except Exception as process_err:
                 error = ErrorInfo('1002', f'Error during video compression: {str(process_err)}', 'Please verify that FFmpeg is properly installed.')
                 print(f"Compression processing error: {str(process_err)}")
-                return error, aes_key
+                return None, error
         case 2:
             try:
-                processed_filename, output_path = handle_resolution_change(filename, config['dir_path'], req_data)
+                processed_filename, output_path = handle_resolution_change(filename, dir_path, req_data, cancel_event, output_dir)
                 print(f'Resolution change completed: {processed_filename}')
-                error  = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
-
-                if error is not None:
-                    return error, aes_key
-
             except Exception as process_err:
                 error = ErrorInfo('1003', f'Error during video processing: {str(process_err)}', 'Please verify that FFmpeg is properly installed.')
                 print(f"Resolution processing error: {str(process_err)}")
-                return error, aes_key
+                return None, error
         case 3:
             try:
-                processed_filename, output_path = handle_aspect_change(filename, config['dir_path'], req_data)
+                processed_filename, output_path = handle_aspect_change(filename, dir_path, req_data, cancel_event, output_dir)
                 print(f'Aspect ratio change completed: {processed_filename}')
-                error = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
-
-                if error is not None:
-                    return error, aes_key
-
             except Exception as process_err:
                 error = ErrorInfo('1004', f'Error during video aspect ratio change: {str(process_err)}', 'Please check the uploaded video and try uploading and processing again. If the issue persists, contact the administrator.')
                 print(f"Processing error: {str(process_err)}")
-                return error, aes_key
+                return None, error
         case 4:
             try:
-                processed_filename, output_path = handle_video_conversion(filename, config['dir_path'])
+                processed_filename, output_path = handle_video_conversion(filename, dir_path, cancel_event)
                 print(f'Audio conversion completed: {processed_filename}')
-                error  = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
-
-                if error is not None:
-                    return error, aes_key
-
             except Exception as process_err:
                 error = ErrorInfo('1005', f'Error during audio conversion: {str(process_err)}', 'Please check the uploaded video and try uploading and processing again. If the issue persists, contact the administrator.')
                 print(f"Audio conversion error: {str(process_err)}")
-                return error, aes_key
+                return None, error
         case 5:
-                filepath = os.path.join(config['dir_path'], filename)
-                error = validate_video_duration(filepath,req_data.get('endseconds'))
-                if error != None:
-                    return error, aes_key
-                
-                try:
-                    processed_filename,output_path = handle_process_video_clip(filename, config['dir_path'], req_data)
-                    print(f'Time-range video creation completed: {processed_filename}')
-                    send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
-
-                except Exception as process_err:
-                    error = ErrorInfo('1006', f'Error during video processing: {str(process_err)}', 'Please check the uploaded video again and retry.')
-                    print(f"Processing error: {str(process_err)}")
-                    return error, aes_key
+            error = validate_video_duration(input_path,req_data.get('endseconds'))
+            if error != None:
+                return None, error
 
-    inputfile_path = os.path.join(config['dir_path'], filename)
-    delete_tmp_files([inputfile_path, output_path])
+            try:
+                processed_filename,output_path = handle_process_video_clip(filename, dir_path, req_data, config, cancel_event, output_dir)
+                print(f'Time-range video creation completed: {processed_filename}')
+            except Exception as process_err:
+                error = ErrorInfo('1006', f'Error during video processing: {str(process_err)}', 'Please check the uploaded video again and retry.')
+                print(f"Processing error: {str(process_err)}")
+                return None, error
+        case _:
+            error = ErrorInfo('1008', f'Unknown action: {action}', 'Please select an operation from the menu.')
+            return None, error
 
-    return None, aes_key
+    output_path = global_scratch.commit(output_path)
+    print(f"Scratch storage usage: {global_scratch.stats()}")
+    return output_path, None
 
-def store_uploaded_file_encrypted(config, connection, filename, original_file_size, aes_key):
+def store_uploaded_file_encrypted(config, connection, filepath, original_file_size, aes_key, offset=0, upload_id=None, client_id=None, sha256=None):
+    total_received = offset
     try:
-        with open(os.path.join(config['dir_path'], filename), 'wb+') as f:
-            total_received = 0
-            
-            while total_received < original_file_size:
-                remaining = original_file_size - total_received
+        # Resumed uploads append to the bytes already verified in an earlier connection
+        with open(filepath, 'r+b' if offset > 0 else 'wb+') as f:
+            if sha256 is not None:
+                while f.tell() < offset and (chunk := f.read(min(1024 * 1024, offset - f.tell()))):
+                    sha256.update(chunk)
+            f.seek(offset)
+            f.truncate()
+            last_checkpoint = total_received
 
-                chunk_size = min(config['stream_rate'], remaining)
-                encrypted_chunk_size = chunk_size + 12 + 16
+            try:
+                while total_received < original_file_size:
+                    remaining = original_file_size - total_received
+
+                    chunk_size = min(config['stream_rate'], remaining)
+                    encrypted_chunk_size = chunk_size + 12 + 16
+
+                    encrypted_chunk = b''
+                    while len(encrypted_chunk) < encrypted_chunk_size:
+                        data = connection.recv(encrypted_chunk_size - len(encrypted_chunk))
+                        if not data:
+                            raise Exception("Connection closed unexpectedly")
+                        encrypted_chunk += data
+
+                    # Waiting for tokens delays the next read, so TCP flow control slows down the sender
+                    if client_id is not None:
+                        global_clients.throttle(client_id, 'upload', encrypted_chunk_size)
+
+                    decrypted_chunk = decrypt_chunk(encrypted_chunk, aes_key)
 
-                encrypted_chunk = b''
-                while len(encrypted_chunk) < encrypted_chunk_size:
-                    data = connection.recv(encrypted_chunk_size - len(encrypted_chunk))
-                    if not data:
-                        raise Exception("Connection closed unexpectedly")
-                    encrypted_chunk += data
+                    actual_chunk_size = min(len(decrypted_chunk), remaining)
+                    f.write(decrypted_chunk[:actual_chunk_size])
+                    if sha256 is not None:
+                        sha256.update(decrypted_chunk[:actual_chunk_size])
+                    total_received += actual_chunk_size
 
-                decrypted_chunk = decrypt_chunk(encrypted_chunk, aes_key)
+                    if upload_id is not None and total_received - last_checkpoint >= config['checkpoint_interval']:
+                        checkpoint_upload(config, upload_id, f, filepath, original_file_size, total_received)
+                        last_checkpoint = total_received
 
-                actual_chunk_size = min(len(decrypted_chunk), remaining)
-                f.write(decrypted_chunk[:actual_chunk_size])
-                total_received += actual_chunk_size
+            finally:
+                # Every byte written so far passed GCM authentication, so it is safe to resume from here
+                if upload_id is not None and total_received < original_file_size:
+                    checkpoint_upload(config, upload_id, f, filepath, original_file_size, total_received)
+
+        if upload_id is not None and os.path.exists(upload_checkpoint_path(config, upload_id)):
+            delete_tmp_files([upload_checkpoint_path(config, upload_id)])
 
         print('File upload completed successfully.')
         return None
@@ -282,27 +525,1263 @@ def store_uploaded_file_encrypted(config, connection, filename, original_file_si
         try:
             remaining = original_file_size - total_received
             while remaining > 0:
-                chunk_size = min(config['stream_rate'] + 28, remaining)
-                connection.recv(chunk_size)
-                remaining -= (chunk_size - 28)
+                chunk_size = min(config['stream_rate'], remaining)
+                receive_exact(connection, chunk_size + 28)
+                remaining -= chunk_size
         except:
             pass
             
-        error = ErrorInfo('1001', 'Error during file storage:' + str(file_err), 'If the issue persists, please contact the administrator.')
+        error = ErrorInfo('1001', 'Error during file storage:' + str(file_err), 'If the issue persists, please contact the administrator.', upload_id)
         return error
 
+# Admission control functions implementation starts here
+class AdmissionController:
+    """Limits how many jobs run at once and queues the rest with weighted fair queueing between clients.
+    Each ticket gets a finish tag of its estimated duration divided by the client's weight, counted from the later of the
+    client's previous tag and the tag of the last admitted job (self-clocked fair queueing); the smallest tag runs next.
+    A client with many queued jobs therefore takes turns with others instead of holding the queue.
+    Recent job durations per action are kept for these estimates and to estimate how long a queued client will wait.
+    When slot_limit is given (coordinator), it is called for the number of job slots instead of using max_active_jobs."""
+    def __init__(self, max_active_jobs, max_queue_length, default_job_seconds, weight_of, history_size=20, slot_limit=None) -> None:
+        self.max_active_jobs = max(1, max_active_jobs)
+        self.slot_limit = slot_limit
+        self.max_queue_length = max_queue_length
+        self.default_job_seconds = default_job_seconds
+        self.weight_of = weight_of
+        self.history_size = history_size
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = []
+        self.durations = {}
+        self.virtual_time = 0.0
+        self.last_finish_tags = {}
+        self.sequence = 0
+
+    def enqueue(self, action, client_id, force=False):
+        """Returns a ticket for the queue, or None when the queue is full (force bypasses the limit)"""
+        with self.condition:
+            has_free_slot = len(self.running) < self.slots() and not self.waiting
+            if not force and not has_free_slot and len(self.waiting) >= self.max_queue_length:
+                return None
+
+            finish_tag = self.finish_tag(action, client_id)
+            self.last_finish_tags[client_id] = finish_tag
+            self.sequence += 1
+            ticket = {'action': action, 'client_id': client_id, 'finish_tag': finish_tag, 'sequence': self.sequence, 'queued_at': time.time(), 'started_at': None}
+            self.waiting.append(ticket)
+            return ticket
+
+    def finish_tag(self, action, client_id):
+        """Returns the finish tag a job of the client would get if it was enqueued now"""
+        with self.condition:
+            start_tag = max(self.virtual_time, self.last_finish_tags.get(client_id, 0.0))
+            return start_tag + self.average_duration(action) / self.weight_of(client_id)
+
+    def queue_order(self, action, client_id):
+        """Sort key for choosing between jobs not yet enqueued (jobs waiting in the durable job queue).
+        Equal finish tags go to the client whose last job finished earlier in virtual time, i.e. that was served less recently."""
+        with self.condition:
+            return self.finish_tag(action, client_id), self.last_finish_tags.get(client_id, 0.0)
+
+    def slots(self):
+        if self.slot_limit is None:
+            return self.max_active_jobs
+        return max(1, self.slot_limit())
+
+    def _order(self, ticket):
+        return ticket['finish_tag'], ticket['sequence']
+
+    def wait(self, ticket, timeout):
+        """Waits up to timeout seconds for the ticket to get a job slot. Returns True once it has one"""
+        with self.condition:
+            admitted = self.condition.wait_for(
+                lambda: min(self.waiting, key=self._order) is ticket and len(self.running) < self.slots(),
+                timeout
+            )
+            if admitted:
+                self.waiting.remove(ticket)
+                self.virtual_time = max(self.virtual_time, ticket['finish_tag'])
+                ticket['started_at'] = time.time()
+                self.running.append(ticket)
+                self.condition.notify_all()
+            return admitted
+
+    def leave(self, ticket):
+        with self.condition:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+
+    def record_duration(self, ticket, seconds):
+        """Records how long the ticket's job ran, without the upload, preview and download around it"""
+        with self.condition:
+            history = self.durations.setdefault(ticket['action'], deque(maxlen=self.history_size))
+            history.append(seconds)
+            ticket['job_seconds'] = seconds
+
+    def release(self, ticket):
+        with self.condition:
+            if ticket in self.running:
+                self.running.remove(ticket)
+                self.condition.notify_all()
+                global_clients.record_job(ticket['client_id'], ticket['started_at'] - ticket['queued_at'], ticket.get('job_seconds', 0))
+
+    def average_duration(self, action):
+        history = self.durations.get(action)
+        if not history:
+            return self.default_job_seconds
+        return sum(history) / len(history)
+
+    def estimate(self, ticket=None):
+        """Returns (queue position, estimated wait in seconds) of a queued ticket, or of a new arrival when ticket is None"""
+        with self.condition:
+            ahead = [t for t in self.waiting if self._order(t) < self._order(ticket)] if ticket in self.waiting else list(self.waiting)
+            now = time.time()
+            remaining_running = sum(max(self.average_duration(t['action']) - (now - t['started_at']), 0) for t in self.running)
+            queued_work = sum(self.average_duration(t['action']) for t in ahead)
+            return len(ahead) + 1, round((remaining_running + queued_work) / self.slots())
+
+def initialize_admission(config):
+    global global_admission
+    # A coordinator runs as many jobs at once as its healthy workers have slots
+    slot_limit = global_worker_registry.total_slots if config['role'] == 'coordinator' else None
+    global_admission = AdmissionController(config['max_active_jobs'], config['max_queue_length'], config['default_job_seconds'], global_clients.weight, slot_limit=slot_limit)
+
+def wait_for_admission(config, connection, req_data, aes_key, client_id):
+    """Holds a client until a job slot is free. Returns (ticket, ErrorInfo | None)"""
+    ticket = global_admission.enqueue(req_data.get('action', 0), client_id)
+    if ticket is None:
+        queue_position, estimated_wait = global_admission.estimate()
+        print(f"Queue is full. Client rejected (estimated wait {estimated_wait} seconds)")
+        return None, ErrorInfo('1011', 'The server is busy and its queue is full', f'Please retry in about {estimated_wait} seconds.', retry_after=estimated_wait)
+
+    try:
+        timeout = 0
+        while not global_admission.wait(ticket, timeout):
+            queue_position, estimated_wait = global_admission.estimate(ticket)
+            # Only protocol version 2 clients expect status messages before the upload starts
+            if req_data.get('protocol_version', 1) >= 2:
+                queued_json = json.dumps({'queue_position': queue_position, 'estimated_wait_seconds': estimated_wait})
+                send_encrypted_message(connection, RESPONSE_QUEUED, queued_json, aes_key)
+            timeout = config['queue_status_interval']
+    except Exception:
+        global_admission.leave(ticket)
+        raise
+
+    return ticket, None
+
+# Client fairness functions implementation starts here
+def client_identity(client_public_key, client_address):
+    """Identifies a client by the fingerprint of its verified public key, or by its address otherwise"""
+    if client_public_key is not None:
+        der = client_public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+        return 'key:' + hashlib.sha256(der).hexdigest()[:16]
+    return 'addr:' + client_address[0]
+
+class TokenBucket:
+    """Allows rate bytes per second with bursts of up to burst bytes. Tokens may go negative, and the caller then
+    sleeps off the debt, so concurrent transfers of one client share its rate."""
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount) -> float:
+        """Takes amount tokens, sleeping until they are available. Returns the seconds slept"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+class ClientAccounting:
+    """Weights, bandwidth buckets and usage statistics per client. Statistics are kept in a JSON file across restarts."""
+    def __init__(self, usage_path, weights, default_weight, bandwidth, burst) -> None:
+        self.usage_path = usage_path
+        self.weights = weights
+        self.default_weight = default_weight
+        self.bandwidth = bandwidth
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.usage = {}
+        if os.path.exists(usage_path):
+            with open(usage_path, 'r', encoding='utf-8') as f:
+                self.usage = json.load(f)
+
+    def weight(self, client_id):
+        return max(self.weights.get(client_id, self.default_weight), 0.01)
+
+    def _usage(self, client_id):
+        # Called with the lock held
+        return self.usage.setdefault(client_id, {
+            'connections': 0, 'jobs': 0, 'wait_seconds': 0.0, 'job_seconds': 0.0,
+            'bytes_uploaded': 0, 'bytes_downloaded': 0, 'throttled_seconds': 0.0, 'last_seen': None
+        })
+
+    def record_connection(self, client_id):
+        with self.lock:
+            usage = self._usage(client_id)
+            usage['connections'] += 1
+            usage['last_seen'] = time.time()
+
+    def record_job(self, client_id, wait_seconds, job_seconds):
+        with self.lock:
+            usage = self._usage(client_id)
+            usage['jobs'] += 1
+            usage['wait_seconds'] += wait_seconds
+            usage['job_seconds'] += job_seconds
+
+    def throttle(self, client_id, direction, nbytes):
+        """Counts transferred bytes and, when client_bandwidth is set, holds the transfer to the client's share of it"""
+        delay = 0.0
+        if self.bandwidth > 0:
+            with self.lock:
+                # Each direction has its own bucket, with a rate proportional to the client's weight
+                bucket = self.buckets.get((client_id, direction))
+                if bucket is None:
+                    bucket = self.buckets[(client_id, direction)] = TokenBucket(self.bandwidth * self.weight(client_id), self.burst)
+            delay = bucket.consume(nbytes)
+
+        with self.lock:
+            usage = self._usage(client_id)
+            usage['bytes_uploaded' if direction == 'upload' else 'bytes_downloaded'] += nbytes
+            usage['throttled_seconds'] += delay
+
+    def save(self):
+        with self.lock:
+            tmp_path = f'{self.usage_path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.usage, f, indent=2)
+            os.replace(tmp_path, self.usage_path)
+
+def initialize_client_accounting(config):
+    global global_clients
+    global_clients = ClientAccounting(
+        os.path.join(config['dir_path'], 'client_usage.json'),
+        config['client_weights'],
+        config['default_client_weight'],
+        config['client_bandwidth'],
+        config['client_burst']
+    )
+    if config['client_bandwidth'] > 0:
+        print(f"Client bandwidth limited to {config['client_bandwidth']} bytes/s per unit of weight in each direction")
+
+# Resumable upload functions implementation starts here
+def upload_checkpoint_path(config, upload_id):
+    return os.path.join(config['dir_path'], f'{upload_id}.upload.json')
+
+def load_upload_checkpoint(config, upload_id):
+    try:
+        with open(upload_checkpoint_path(config, upload_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def checkpoint_upload(config, upload_id, f, filepath, file_size, received):
+    """Flush received bytes to disk, then atomically record how many of them are durable"""
+    f.flush()
+    os.fsync(f.fileno())
+
+    checkpoint_path = upload_checkpoint_path(config, upload_id)
+    with open(checkpoint_path + '.tmp', 'w', encoding='utf-8') as cf:
+        json.dump({'filepath': filepath, 'file_size': file_size, 'received': received, 'updated_at': time.time()}, cf)
+        cf.flush()
+        os.fsync(cf.fileno())
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+def prepare_resumable_upload(config, requested_upload_id, mediatype, file_size):
+    """Returns (upload_id, filepath, offset), continuing a previous upload when its checkpoint is still usable.
+    The returned upload is marked active until finish_resumable_upload is called.
+    Partial uploads are always kept on disk, so their checkpoints survive a reboot and abandoned uploads do not hold RAM."""
+    if isinstance(requested_upload_id, str) and len(requested_upload_id) == 32 and all(c in '0123456789abcdef' for c in requested_upload_id):
+        with global_active_uploads_lock:
+            # Another connection may still be receiving this upload (e.g. before the server noticed the old connection dropped)
+            active = requested_upload_id in global_active_uploads
+            checkpoint = None if active else load_upload_checkpoint(config, requested_upload_id)
+            if checkpoint is not None and checkpoint['file_size'] == file_size:
+                filepath = checkpoint['filepath']
+                if os.path.exists(filepath) and os.path.getsize(filepath) >= checkpoint['received']:
+                    print(f"Resuming upload {requested_upload_id} from offset {checkpoint['received']}")
+                    global_active_uploads.add(requested_upload_id)
+                    global_scratch.register(filepath, file_size)
+                    return requested_upload_id, filepath, checkpoint['received']
+
+        if active:
+            print(f"Upload {requested_upload_id} is still being received on another connection. Starting a new upload")
+        else:
+            print(f"Upload {requested_upload_id} cannot be resumed. Starting a new upload")
+
+    upload_id = uuid.uuid4().hex
+    with global_active_uploads_lock:
+        global_active_uploads.add(upload_id)
+    return upload_id, global_scratch.allocate(f'{upload_id}.{mediatype}', file_size, durable=True), 0
+
+def finish_resumable_upload(upload_id):
+    """Marks an upload as no longer being received, so it can be resumed or purged"""
+    with global_active_uploads_lock:
+        global_active_uploads.discard(upload_id)
+
+def purge_expired_uploads(config):
+    """Function to delete partial uploads that have not been resumed within the retention period"""
+    now = time.time()
+    for entry in os.listdir(config['dir_path']):
+        if not entry.endswith('.upload.json'):
+            continue
+
+        upload_id = entry[:-len('.upload.json')]
+        with global_active_uploads_lock:
+            if upload_id in global_active_uploads:
+                continue
+            checkpoint = load_upload_checkpoint(config, upload_id)
+            if checkpoint is None or now - checkpoint.get('updated_at', 0) > config['upload_retention_seconds']:
+                paths = [upload_checkpoint_path(config, upload_id)]
+                if checkpoint is not None:
+                    paths.append(checkpoint['filepath'])
+                global_scratch.delete(paths)
+                print(f"Expired upload {upload_id} purged")
+
+def initialize_uploads(config):
+    global global_active_uploads, global_active_uploads_lock
+    global_active_uploads = set()
+    global_active_uploads_lock = threading.Lock()
+    purge_expired_uploads(config)
+
+# Asynchronous job functions implementation starts here
+class JobQueue:
+    """Durable job queue stored in SQLite, so submitted jobs survive a server restart"""
+    def __init__(self, db_path) -> None:
+        self.db_path = db_path
+        with closing(self._connect()) as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    req_params TEXT NOT NULL,
+                    input_path TEXT NOT NULL,
+                    output_path TEXT,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            # Databases created before jobs were scheduled per client get the column added
+            if 'client_id' not in [column[1] for column in db.execute('PRAGMA table_info(jobs)')]:
+                db.execute("ALTER TABLE jobs ADD COLUMN client_id TEXT NOT NULL DEFAULT 'anonymous'")
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_client ON jobs (status, client_id, created_at)')
+
+    def _connect(self):
+        # A connection per call keeps the queue safe to use from the accept loop and every worker thread
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def submit(self, req_data, input_path) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute(
+                'INSERT INTO jobs (job_id, req_params, input_path, status, created_at, updated_at, client_id) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, json.dumps(req_data), input_path, 'queued', now, now, req_data.get('client_id', 'anonymous'))
+            )
+        return job_id
+
+    def claim_next(self, order_key=None):
+        """Marks the next queued job as running and returns it, or None when the queue is empty.
+        Only the oldest queued job of each client is a candidate; order_key chooses among them (oldest first without it)."""
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute(
+                """SELECT job_id, req_params, input_path, client_id, created_at FROM jobs AS job
+                WHERE status = 'queued' AND created_at = (
+                    SELECT MIN(created_at) FROM jobs WHERE status = 'queued' AND client_id = job.client_id
+                )"""
+            ).fetchall()
+            if not rows:
+                db.execute('COMMIT')
+                return None
+            candidates = [{'job_id': row[0], 'req_data': json.loads(row[1]), 'input_path': row[2], 'client_id': row[3], 'created_at': row[4]} for row in rows]
+            job = min(candidates, key=lambda candidate: (order_key(candidate) if order_key is not None else 0, candidate['created_at']))
+            db.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE job_id = ?", (time.time(), job['job_id']))
+            db.execute('COMMIT')
+            return job
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+
+    def _update(self, job_id, status, output_path=None, error=None):
+        with closing(self._connect()) as db:
+            db.execute(
+                'UPDATE jobs SET status = ?, output_path = COALESCE(?, output_path), error = ?, updated_at = ? WHERE job_id = ?',
+                (status, output_path, error, time.time(), job_id)
+            )
+
+    def complete(self, job_id, output_path):
+        self._update(job_id, 'done', output_path=output_path)
+
+    def fail(self, job_id, error_info):
+        self._update(job_id, 'failed', error=error_info.to_json())
+
+    def mark_fetched(self, job_id):
+        self._update(job_id, 'fetched')
+
+    def get(self, job_id):
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT job_id, status, output_path, error, created_at FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {'job_id': row[0], 'status': row[1], 'output_path': row[2], 'error': row[3], 'created_at': row[4]}
+
+    def get_status(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+
+        status = {'job_id': job_id, 'status': job['status']}
+        if job['status'] == 'queued':
+            with closing(self._connect()) as db:
+                ahead = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (job['created_at'],)).fetchone()[0]
+            status['queue_position'] = ahead + 1
+        elif job['status'] == 'failed':
+            status['error'] = json.loads(job['error'])
+        return status
+
+    def requeue_interrupted(self) -> int:
+        """Jobs left running by a stopped server are queued again"""
+        with closing(self._connect()) as db:
+            return db.execute("UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'", (time.time(),)).rowcount
+
+    def purge_expired(self, retention_seconds):
+        """Deletes finished jobs older than the retention period and returns the files they referenced"""
+        cutoff = time.time() - retention_seconds
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT input_path, output_path FROM jobs WHERE status IN ('done', 'failed', 'fetched') AND updated_at < ?", (cutoff,)).fetchall()
+            db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed', 'fetched') AND updated_at < ?", (cutoff,))
+        return [path for row in rows for path in row if path is not None]
+
+def initialize_job_queue(config):
+    global global_job_queue, global_job_event
+    global_job_queue = JobQueue(os.path.join(config['dir_path'], 'jobs.sqlite3'))
+    # Set on submit, so idle workers pick up new jobs without waiting for the next poll
+    global_job_event = threading.Event()
+
+    requeued = global_job_queue.requeue_interrupted()
+    if requeued > 0:
+        print(f"{requeued} interrupted jobs queued again")
+
+    for index in range(config['job_workers']):
+        threading.Thread(target=job_worker_loop, args=(config,), name=f'job-worker-{index}', daemon=True).start()
+    print(f"{config['job_workers']} job workers started")
+
+def job_worker_loop(config):
+    last_purge = 0
+    while True:
+        # Queued jobs are taken in weighted fair order between clients, so one client's backlog does not hold up the others
+        job = global_job_queue.claim_next(lambda job: global_admission.queue_order(job['req_data'].get('action', 0), job['client_id']))
+
+        if job is None:
+            if time.time() - last_purge > 600:
+                global_scratch.delete(global_job_queue.purge_expired(config['job_retention_seconds']))
+                purge_expired_uploads(config)
+                last_purge = time.time()
+
+            global_job_event.wait(timeout=config['job_poll_interval'])
+            global_job_event.clear()
+            continue
+
+        # Queued jobs share the job slots with clients processed on their connection
+        ticket = global_admission.enqueue(job['req_data'].get('action', 0), job['client_id'], force=True)
+        global_admission.wait(ticket, None)
+
+        print(f"Job {job['job_id']} started")
+        inputfile_path = job['input_path']
+        try:
+            # Results of queued jobs must survive a restart until they are fetched
+            job_started = time.time()
+            output_path, error = execute_job(config, inputfile_path, job['req_data'], durable=True)
+            if error is None:
+                global_admission.record_duration(ticket, time.time() - job_started)
+        except Exception as e:
+            output_path, error = None, ErrorInfo('1002', str(e), 'If the issue persists, please contact the administrator.')
+        finally:
+            global_admission.release(ticket)
+            global_clients.save()
+
+        if error is not None:
+            global_job_queue.fail(job['job_id'], error)
+            print(f"Job {job['job_id']} failed: {error.description}")
+        else:
+            global_job_queue.complete(job['job_id'], output_path)
+            print(f"Job {job['job_id']} completed")
+
+        global_scratch.delete([inputfile_path])
+
+def handle_job_request(config, connection, req_data, mode, aes_key, client_id):
+    """Answers a poll with the job status, or a fetch with the result file once the job is done"""
+    job_id = req_data.get('job_id')
+    job = global_job_queue.get(job_id) if isinstance(job_id, str) else None
+    if job is None or job['status'] == 'fetched':
+        return ErrorInfo('1009', f'Job not found: {job_id}', 'Please check the job ID. Results can only be fetched once.')
+
+    if mode == 'fetch' and job['status'] == 'done':
+        error = send_encrypted_response(connection, job['output_path'], config['stream_rate'], aes_key, client_id=client_id)
+        if error is None:
+            global_job_queue.mark_fetched(job_id)
+            global_scratch.delete([job['output_path']])
+        return error
+
+    if mode == 'fetch' and job['status'] == 'failed':
+        job_error = json.loads(job['error'])
+        return ErrorInfo(job_error['error_code'], job_error['description'], job_error['solution'])
+
+    # Polls, and fetches of unfinished jobs, receive the current status
+    status_json = json.dumps(global_job_queue.get_status(job_id), ensure_ascii=False)
+    send_encrypted_message(connection, RESPONSE_JOB_STATUS, status_json, aes_key)
+    return None
+
+# Coordinator/worker functions implementation starts here
+# Files travel between coordinator and workers in larger frames than the client stream_rate
+CLUSTER_CHUNK_SIZE = 1024 * 1024
+# Largest frame a cluster peer may send: a full chunk plus nonce and tag. Frames are read before they are authenticated
+CLUSTER_FRAME_SIZE = CLUSTER_CHUNK_SIZE + 12 + 16
+
+def open_cluster_channel(connection, cluster_secret, initiator):
+    """Derives the AES key of an internal connection from the shared secret and a nonce from each side.
+    A peer without the secret cannot produce or read a single valid frame."""
+    local_nonce = os.urandom(16)
+    connection.sendall(local_nonce)
+    remote_nonce = receive_exact(connection, 16)
+
+    initiator_nonce, responder_nonce = (local_nonce, remote_nonce) if initiator else (remote_nonce, local_nonce)
+    return hmac.new(cluster_secret.encode('utf-8'), b'video_compressor cluster' + initiator_nonce + responder_nonce, hashlib.sha256).digest()
+
+def send_cluster_message(connection, message, channel_key):
+    send_encrypted_frame(connection, json.dumps(message, ensure_ascii=False).encode('utf-8'), channel_key)
+
+def receive_cluster_message(connection, channel_key):
+    return json.loads(receive_encrypted_frame(connection, channel_key, CLUSTER_FRAME_SIZE).decode('utf-8'))
+
+def connect_cluster_peer(config, address, port, timeout=None):
+    connection = socket.create_connection((address, port), timeout=config['worker_timeout'])
+    connection.settimeout(timeout)
+    enable_cluster_keepalive(connection, config['worker_timeout'])
+    return connection, open_cluster_channel(connection, config['cluster_secret'], initiator=True)
+
+def enable_cluster_keepalive(connection, worker_timeout):
+    """Makes an idle connection to a host that disappeared without a reset fail after about worker_timeout seconds,
+    instead of after the system default of hours"""
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # These options are not available on every platform
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        interval = max(1, int(worker_timeout) // 3)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, interval)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+def send_file_frames(connection, filepath, channel_key):
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(CLUSTER_CHUNK_SIZE)
+            if not data:
+                break
+            send_encrypted_frame(connection, data, channel_key)
+
+def receive_file_frames(connection, filepath, file_size, channel_key):
+    with open(filepath, 'wb') as f:
+        total_received = 0
+        while total_received < file_size:
+            data = receive_encrypted_frame(connection, channel_key, CLUSTER_FRAME_SIZE)
+            f.write(data)
+            total_received += len(data)
+
+class WorkerRegistry:
+    """Workers known to the coordinator, with their reported load and the jobs dispatched to them"""
+    def __init__(self, worker_timeout) -> None:
+        self.worker_timeout = worker_timeout
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def heartbeat(self, worker_info):
+        with self.lock:
+            worker = self.workers.setdefault(worker_info['worker_id'], {'in_flight': 0})
+            if not worker.get('healthy', False):
+                print(f"Worker {worker_info['worker_id']} registered")
+            worker.update({
+                'worker_id': worker_info['worker_id'],
+                'address': worker_info['address'],
+                'port': worker_info['port'],
+                'slots': max(1, worker_info['slots']),
+                'active_jobs': worker_info['active_jobs'],
+                'last_seen': time.time(),
+                'healthy': True
+            })
+
+    def mark_failed(self, worker_id):
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            if worker is not None and worker['healthy']:
+                worker['healthy'] = False
+                print(f"Worker {worker_id} marked unhealthy")
+
+    def healthy_workers(self):
+        now = time.time()
+        with self.lock:
+            for worker in self.workers.values():
+                if worker['healthy'] and now - worker['last_seen'] > self.worker_timeout:
+                    worker['healthy'] = False
+                    print(f"Worker {worker['worker_id']} missed its heartbeats")
+            return [dict(worker) for worker in self.workers.values() if worker['healthy']]
+
+    def acquire(self, excluded_ids):
+        """Chooses the healthy worker with the lowest load per slot and counts the job against it"""
+        candidates = [worker for worker in self.healthy_workers() if worker['worker_id'] not in excluded_ids]
+        if not candidates:
+            return None
+
+        with self.lock:
+            def load(worker):
+                current = self.workers[worker['worker_id']]
+                return max(current['in_flight'], current['active_jobs']) / current['slots']
+
+            chosen = min(candidates, key=load)
+            self.workers[chosen['worker_id']]['in_flight'] += 1
+            return chosen
+
+    def release(self, worker_id):
+        with self.lock:
+            self.workers[worker_id]['in_flight'] -= 1
+
+    def total_slots(self):
+        return sum(worker['slots'] for worker in self.healthy_workers())
+
+    def is_healthy(self, worker_id):
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            return worker is not None and worker['healthy']
+
+def initialize_coordinator(config):
+    global global_worker_registry
+    global_worker_registry = WorkerRegistry(config['worker_timeout'])
+
+    registration_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    registration_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    registration_sock.bind((config['coordinator_address'], config['coordinator_port']))
+    registration_sock.listen(16)
+
+    threading.Thread(target=accept_worker_heartbeats, args=(config, registration_sock), name='worker-registration', daemon=True).start()
+    threading.Thread(target=check_worker_health, args=(config,), name='worker-health-check', daemon=True).start()
+    print(f"Coordinator accepting worker registrations on port {config['coordinator_port']}")
+
+def accept_worker_heartbeats(config, registration_sock):
+    while True:
+        connection, worker_address = registration_sock.accept()
+        try:
+            connection.settimeout(config['worker_timeout'])
+            channel_key = open_cluster_channel(connection, config['cluster_secret'], initiator=False)
+            message = receive_cluster_message(connection, channel_key)
+            if message.get('type') == 'heartbeat':
+                global_worker_registry.heartbeat(message)
+                send_cluster_message(connection, {'type': 'ok'}, channel_key)
+        except Exception as e:
+            print(f"Rejected worker registration from {worker_address}: {e}")
+        finally:
+            connection.close()
+
+def check_worker_health(config):
+    """Pings every registered worker on its job port, so unreachable workers stop receiving jobs"""
+    while True:
+        time.sleep(config['worker_heartbeat_interval'])
+        for worker in global_worker_registry.healthy_workers():
+            try:
+                connection, channel_key = connect_cluster_peer(config, worker['address'], worker['port'], config['worker_timeout'])
+                with connection:
+                    send_cluster_message(connection, {'type': 'ping'}, channel_key)
+                    if receive_cluster_message(connection, channel_key).get('type') != 'pong':
+                        raise Exception('Unexpected health check response')
+            except Exception as e:
+                print(f"Health check of worker {worker['worker_id']} failed: {e}")
+                global_worker_registry.mark_failed(worker['worker_id'])
+
+def execute_job(config, inputfile_path, req_data, cancel_event=None, durable=False):
+    """Runs a job locally, or on a worker when this server is the coordinator. Returns (output_path, ErrorInfo | None)
+    Setting cancel_event stops the job; a cancelled job returns error 1014. Durable jobs (queued jobs) keep their output on disk."""
+    if config['role'] == 'coordinator':
+        output_path, error = dispatch_job(config, inputfile_path, req_data, cancel_event, durable)
+    else:
+        output_path, error = run_action(config, inputfile_path, req_data, cancel_event)
+
+    if cancel_event is not None and cancel_event.is_set():
+        if output_path is not None:
+            global_scratch.delete([output_path])
+        return None, ErrorInfo('1014', 'The job was cancelled', 'Start the job again if it was cancelled by mistake.')
+    return output_path, error
+
+def dispatch_job(config, inputfile_path, req_data, cancel_event=None, durable=False):
+    filename = os.path.basename(inputfile_path)
+    attempted_ids = set()
+
+    for attempt in range(config['dispatch_retries'] + 1):
+        worker = global_worker_registry.acquire(attempted_ids)
+        if worker is None:
+            break
+        attempted_ids.add(worker['worker_id'])
+
+        print(f"Dispatching {filename} to worker {worker['worker_id']} (attempt {attempt + 1})")
+        try:
+            # Reads time out while the worker transfers data; the wait for the result is bounded by the worker's health below
+            connection, channel_key = connect_cluster_peer(config, worker['address'], worker['port'], config['worker_timeout'])
+            with connection:
+                send_cluster_message(connection, {
+                    'type': 'job',
+                    'req_data': req_data,
+                    'mediatype': os.path.splitext(filename)[1].lstrip('.'),
+                    'file_size': os.path.getsize(inputfile_path)
+                }, channel_key)
+                send_file_frames(connection, inputfile_path, channel_key)
+
+                # Closing the connection makes the worker stop FFmpeg. A worker that fails its health checks
+                # (e.g. its host lost power without closing the connection) is given up and the job retried
+                worker_id = worker['worker_id']
+                if not wait_until_readable(connection, cancel_event, lambda: global_worker_registry.is_healthy(worker_id)):
+                    print(f"Job on worker {worker['worker_id']} cancelled")
+                    return None, None
+
+                result = receive_cluster_message(connection, channel_key)
+                if result['status'] == 'error':
+                    # FFmpeg failures would repeat on any worker, so they are returned instead of retried
+                    job_error = result['error']
+                    return None, ErrorInfo(job_error['error_code'], job_error['description'], job_error['solution'])
+
+                output_path = global_scratch.allocate(f"{filename.split('.')[0]}_result.{result['file_extension']}", result['file_size'], durable)
+                try:
+                    receive_file_frames(connection, output_path, result['file_size'], channel_key)
+                except Exception:
+                    global_scratch.delete([output_path])
+                    raise
+                return output_path, None
+
+        except Exception as e:
+            print(f"Worker {worker['worker_id']} failed: {e}")
+            global_worker_registry.mark_failed(worker['worker_id'])
+
+        finally:
+            global_worker_registry.release(worker['worker_id'])
+
+    return None, ErrorInfo('1010', 'No worker was able to process the job', 'Please try again later. If the issue persists, contact the administrator.')
+
+def run_worker(config):
+    """Entry point of --role worker: runs jobs sent by the coordinator and reports its load"""
+    worker_state = {
+        'worker_id': f"{config['worker_address']}:{config['worker_port']}",
+        'active_jobs': 0,
+        'lock': threading.Lock(),
+        'slots': threading.Semaphore(config['worker_slots'])
+    }
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((config['worker_address'], config['worker_port']))
+    sock.listen(16)
+    print(f"Worker {worker_state['worker_id']} started with {config['worker_slots']} slots")
+
+    threading.Thread(target=send_worker_heartbeats, args=(config, worker_state), name='worker-heartbeat', daemon=True).start()
+
+    while True:
+        connection, coordinator_address = sock.accept()
+        threading.Thread(target=handle_coordinator_request, args=(config, connection, worker_state), daemon=True).start()
+
+def send_worker_heartbeats(config, worker_state):
+    while True:
+        try:
+            connection, channel_key = connect_cluster_peer(config, config['coordinator_address'], config['coordinator_port'], config['worker_timeout'])
+            with connection:
+                send_cluster_message(connection, {
+                    'type': 'heartbeat',
+                    'worker_id': worker_state['worker_id'],
+                    'address': config['worker_address'],
+                    'port': config['worker_port'],
+                    'slots': config['worker_slots'],
+                    'active_jobs': worker_state['active_jobs']
+                }, channel_key)
+                receive_cluster_message(connection, channel_key)
+        except Exception as e:
+            print(f"Heartbeat to coordinator failed: {e}")
+
+        time.sleep(config['worker_heartbeat_interval'])
+
+def handle_coordinator_request(config, connection, worker_state):
+    inputfile_path = None
+    output_path = None
+    try:
+        enable_cluster_keepalive(connection, config['worker_timeout'])
+        channel_key = open_cluster_channel(connection, config['cluster_secret'], initiator=False)
+        message = receive_cluster_message(connection, channel_key)
+
+        if message['type'] == 'ping':
+            send_cluster_message(connection, {'type': 'pong', 'active_jobs': worker_state['active_jobs']}, channel_key)
+            return
+
+        inputfile_path = global_scratch.allocate(f"{uuid.uuid4().hex}.{message['mediatype']}", message['file_size'])
+        receive_file_frames(connection, inputfile_path, message['file_size'], channel_key)
+
+        with worker_state['slots']:
+            with worker_state['lock']:
+                worker_state['active_jobs'] += 1
+            # The coordinator closes the connection when the client cancelled or disconnected
+            cancel_event = threading.Event()
+            stop_event = threading.Event()
+            watcher = threading.Thread(target=watch_connection, args=(connection, cancel_event, stop_event), daemon=True)
+            watcher.start()
+            try:
+                output_path, error = run_action(config, inputfile_path, message['req_data'], cancel_event)
+            finally:
+                stop_event.set()
+                watcher.join()
+                with worker_state['lock']:
+                    worker_state['active_jobs'] -= 1
+
+        if cancel_event.is_set():
+            print('Job cancelled by the coordinator')
+            return
+
+        if error is not None:
+            send_cluster_message(connection, {'type': 'result', 'status': 'error', 'error': error.to_dict()}, channel_key)
+            return
+
+        success_info = SuccessInfo(output_path, os.path.getsize(output_path))
+        send_cluster_message(connection, {'type': 'result', 'status': 'success', **success_info.to_dict()}, channel_key)
+        send_file_frames(connection, output_path, channel_key)
+
+    except Exception as e:
+        print(f"Coordinator request failed: {e}")
+
+    finally:
+        connection.close()
+        global_scratch.delete([path for path in [inputfile_path, output_path] if path is not None])
+
+# Job cancellation functions implementation starts here
+CANCEL_POLL_INTERVAL = 0.2
+# Seconds the rest of a started control frame may take to arrive, so a partial frame cannot block the watcher
+CONTROL_FRAME_TIMEOUT = 10
+
+class JobCancelled(Exception):
+    pass
+
+def run_ffmpeg(ffmpeg_cmd, cancel_event=None):
+    """Runs FFmpeg as a child process and terminates it as soon as cancel_event is set.
+    The output file (last argument) of a cancelled run is deleted."""
+    process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    while True:
+        try:
+            # communicate keeps reading stderr across timeouts, so FFmpeg never blocks on a full pipe
+            _, stderr = process.communicate(timeout=CANCEL_POLL_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel_event is None or not cancel_event.is_set():
+                continue
+
+        # Killed rather than terminated: FFmpeg would flush its encoders on SIGTERM, and the output is discarded anyway
+        process.kill()
+        process.communicate()
+        print(f"FFmpeg terminated: {ffmpeg_cmd[-1]}")
+        delete_tmp_files([ffmpeg_cmd[-1]])
+        raise JobCancelled('The job was cancelled')
+
+    if process.returncode != 0:
+        raise Exception(f"FFmpeg error: {stderr}")
+
+def watch_connection(connection, cancel_event, stop_event, aes_key=None, decision_event=None):
+    """Sets cancel_event when the peer disconnects or, for clients (aes_key given), sends the encrypted cancel message {"cancel": true}
+    or the preview decision {"continue": false}. A decision to continue sets decision_event.
+    Runs until stop_event is set; the caller must not read from the connection meanwhile."""
+    while not stop_event.is_set():
+        readable, _, _ = select.select([connection], [], [], CANCEL_POLL_INTERVAL)
+        if not readable:
+            continue
+
+        try:
+            if not connection.recv(1, socket.MSG_PEEK):
+                print('Peer disconnected. Cancelling the job')
+                cancel_event.set()
+                return
+            if aes_key is None:
+                return
+            connection.settimeout(CONTROL_FRAME_TIMEOUT)
+            try:
+                message = json.loads(receive_encrypted_frame(connection, aes_key).decode('utf-8'))
+            finally:
+                connection.settimeout(None)
+        except Exception as e:
+            print(f"Connection failed while the job was running: {e}")
+            cancel_event.set()
+            return
+
+        # A preview decision of {"continue": false} cancels as well; {"continue": true} lets the job run on
+        if isinstance(message, dict) and (message.get('cancel') or message.get('continue') is False):
+            print('Cancel requested by the client')
+            cancel_event.set()
+            return
+        if isinstance(message, dict) and message.get('continue') and decision_event is not None:
+            decision_event.set()
+
+def execute_job_watched(config, connection, inputfile_path, req_data, aes_key, decision_event=None):
+    """Runs execute_job while watching the client connection, so a disconnect or a cancel message stops the job"""
+    cancel_event = threading.Event()
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=watch_connection, args=(connection, cancel_event, stop_event, aes_key, decision_event), daemon=True)
+    watcher.start()
+    try:
+        return execute_job(config, inputfile_path, req_data, cancel_event)
+    finally:
+        stop_event.set()
+        watcher.join()
+
+def wait_until_readable(connection, cancel_event, is_peer_alive=None) -> bool:
+    """Waits for data on the connection. Returns False when cancel_event was set first.
+    Raises an exception when is_peer_alive reports that the peer is gone."""
+    while cancel_event is None or not cancel_event.is_set():
+        readable, _, _ = select.select([connection], [], [], CANCEL_POLL_INTERVAL)
+        if readable:
+            return True
+        if is_peer_alive is not None and not is_peer_alive():
+            raise Exception('Peer stopped responding to health checks')
+    return False
+
+# Scratch storage functions implementation starts here
+class ScratchStorage:
+    """Places job files in a RAM-backed directory (tmpfs) while they fit the RAM budget, and on disk otherwise.
+    FFmpeg reads and writes these files by path, which is why a tmpfs directory is used rather than anonymous memory."""
+    def __init__(self, disk_dir, ram_dir, ram_budget) -> None:
+        self.dirs = {'disk': os.path.abspath(disk_dir), 'ram': os.path.abspath(ram_dir) if ram_dir is not None else None}
+        self.ram_budget = ram_budget if ram_dir is not None else 0
+        self.lock = threading.Lock()
+        self.files = {}
+        self.usage = {
+            tier: {'bytes': 0, 'peak_bytes': 0, 'files': 0, 'placed_files': 0, 'placed_bytes': 0, 'spilled_files': 0}
+            for tier in self.dirs
+        }
+
+    def _add(self, path, tier, size):
+        self.files[path] = (tier, size)
+        usage = self.usage[tier]
+        usage['bytes'] += size
+        usage['files'] += 1
+        usage['peak_bytes'] = max(usage['peak_bytes'], usage['bytes'])
+
+    def _remove(self, path):
+        tier, size = self.files.pop(path)
+        self.usage[tier]['bytes'] -= size
+        self.usage[tier]['files'] -= 1
+
+    def _tier_of(self, path):
+        if self.dirs['ram'] is not None and os.path.dirname(path) == self.dirs['ram']:
+            return 'ram'
+        return 'disk'
+
+    def allocate(self, filename, expected_size, durable=False):
+        """Returns the path to write a new file to. The RAM tier is used only when the file and an
+        output of the same size fit the budget; durable files (queued jobs) always go to disk."""
+        with self.lock:
+            tier = 'disk'
+            if not durable and self.usage['ram']['bytes'] + 2 * expected_size <= self.ram_budget:
+                tier = 'ram'
+
+            path = os.path.join(self.dirs[tier], filename)
+            self._add(path, tier, expected_size)
+            self.usage[tier]['placed_files'] += 1
+            self.usage[tier]['placed_bytes'] += expected_size
+            return path
+
+    def register(self, path, expected_size):
+        """Accounts for an existing file, e.g. a partial upload that is being resumed"""
+        with self.lock:
+            if path in self.files:
+                self._remove(path)
+            self._add(path, self._tier_of(path), expected_size)
+
+    def commit(self, path):
+        """Accounts for the actual size of a written file (such as an FFmpeg output) and moves it to
+        disk when it pushed the RAM tier over budget. Returns the final path."""
+        size = os.path.getsize(path)
+        with self.lock:
+            if path in self.files:
+                self._remove(path)
+            tier = self._tier_of(path)
+            self._add(path, tier, size)
+            if tier != 'ram' or self.usage['ram']['bytes'] <= self.ram_budget:
+                return path
+
+            self._remove(path)
+            spilled_path = os.path.join(self.dirs['disk'], os.path.basename(path))
+            self._add(spilled_path, 'disk', size)
+            self.usage['ram']['spilled_files'] += 1
+
+        shutil.move(path, spilled_path)
+        print(f"Scratch file {os.path.basename(path)} spilled to disk ({size} bytes)")
+        return spilled_path
+
+    def delete(self, paths):
+        delete_tmp_files(paths)
+        with self.lock:
+            for path in paths:
+                if path in self.files:
+                    self._remove(path)
+
+    def promote(self, path):
+        """Moves a finished file from disk to the RAM tier when it and an output of the same size fit the budget.
+        Returns the final path."""
+        with self.lock:
+            tier, size = self.files.get(path, ('disk', os.path.getsize(path)))
+            if tier != 'disk' or self.dirs['ram'] is None or self.usage['ram']['bytes'] + 2 * size > self.ram_budget:
+                return path
+            if path in self.files:
+                self._remove(path)
+            ram_path = os.path.join(self.dirs['ram'], os.path.basename(path))
+            self._add(ram_path, 'ram', size)
+            self.usage['ram']['placed_files'] += 1
+            self.usage['ram']['placed_bytes'] += size
+
+        try:
+            shutil.move(path, ram_path)
+        except OSError:
+            delete_tmp_files([ram_path])
+            self.register(path, size)
+            self.forget(ram_path)
+            return path
+        return ram_path
+
+    def output_dir(self, input_path, may_grow):
+        """Returns the directory FFmpeg writes a job's output to. FFmpeg fills the file before commit can check the budget,
+        and allocate only reserves room for an output as large as the input, so outputs that can grow go to disk."""
+        if may_grow:
+            return self.dirs['disk']
+        return os.path.dirname(input_path)
+
+    def forget(self, path):
+        """Removes an allocated path that was never written from the accounting"""
+        with self.lock:
+            if path in self.files:
+                self._remove(path)
+
+    def stats(self):
+        with self.lock:
+            return {tier: dict(usage) for tier, usage in self.usage.items()}
+
+def prepare_private_directory(path):
+    """Creates path readable only by this user, or checks that an existing path is such a directory.
+    The RAM scratch directory lives in a world-writable parent (/dev/shm), where another local user could create it
+    first to read the decrypted uploads or replace job inputs."""
+    try:
+        os.makedirs(path, mode=0o700)
+    except FileExistsError:
+        pass
+
+    # lstat, so a symbolic link placed at the path is rejected instead of followed
+    path_stat = os.lstat(path)
+    if not stat.S_ISDIR(path_stat.st_mode) or path_stat.st_uid != os.getuid():
+        raise OSError(f"{path} is not a directory owned by this user")
+    if path_stat.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+def initialize_scratch_storage(config):
+    global global_scratch
+    ram_dir = config['scratch_ram_dir']
+    if ram_dir and config['scratch_ram_budget'] > 0:
+        try:
+            prepare_private_directory(ram_dir)
+        except OSError as e:
+            print(f"RAM scratch directory {ram_dir} is not available, using disk only: {e}")
+            ram_dir = None
+    else:
+        ram_dir = None
+
+    global_scratch = ScratchStorage(config['dir_path'], ram_dir, config['scratch_ram_budget'])
+    if ram_dir is not None:
+        print(f"Scratch storage: up to {config['scratch_ram_budget']} bytes in {ram_dir}, the rest in {config['dir_path']}")
+
+# Content-addressed input store implementation starts here
+class InputStore:
+    """Keeps copies of uploaded inputs named by their owner and SHA-256, so a client can skip uploading a file it sent before.
+    Each client only sees its own inputs, and an input is only stored the second time the client uploads it, so one-off
+    uploads are never copied out of scratch storage. Files are evicted least recently used first once the store exceeds its budget."""
+    def __init__(self, store_dir, budget, seen_limit=4096) -> None:
+        self.store_dir = store_dir
+        self.budget = budget
+        self.seen_limit = seen_limit
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, client_id, content_hash):
+        owner = hashlib.sha256(client_id.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.store_dir, f'{owner}-{content_hash}')
+
+    def checkout(self, client_id, content_hash, file_size, target_path) -> bool:
+        """Places the client's stored copy at target_path. Returns False when the store does not hold the file."""
+        with self.lock:
+            stored_path = self._path(client_id, content_hash)
+            if not os.path.exists(stored_path) or os.path.getsize(stored_path) != file_size:
+                return False
+            link_or_copy(stored_path, target_path)
+            # Marks the file as recently used for eviction
+            os.utime(stored_path)
+            return True
+
+    def add(self, client_id, content_hash, received_hash, filepath):
+        """Stores a received upload whose hash, computed while receiving it, matches the hash the client announced"""
+        if received_hash != content_hash:
+            print(f"Upload does not match its content hash {content_hash}. Not storing it")
+            return
+
+        with self.lock:
+            key = (client_id, content_hash)
+            if key not in self.seen:
+                self.seen[key] = True
+                if len(self.seen) > self.seen_limit:
+                    self.seen.popitem(last=False)
+                return
+
+            stored_path = self._path(client_id, content_hash)
+            if os.path.exists(stored_path):
+                return
+            tmp_path = f'{stored_path}.{uuid.uuid4().hex}.tmp'
+            link_or_copy(filepath, tmp_path)
+            os.replace(tmp_path, stored_path)
+            self._evict()
+        print(f"Input {content_hash} stored")
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.store_dir):
+            if entry.is_file():
+                entry_stat = entry.stat()
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            delete_tmp_files([path])
+            total -= size
+
+def link_or_copy(source_path, target_path):
+    """Hard links a file, or copies it when the target is on another file system (such as the RAM scratch tier)"""
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+def is_content_hash(value) -> bool:
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def initialize_input_store(config):
+    global global_input_store
+    global_input_store = None
+    if config['input_store_budget'] > 0:
+        global_input_store = InputStore(os.path.join(config['dir_path'], 'inputs'), config['input_store_budget'])
+
+# Preview functions implementation starts here
+def send_preview(config, connection, inputfile_path, req_data, aes_key, client_id) -> bool:
+    """Sends a fast low-resolution preview of the requested job. Returns False when the client cancelled while it was created.
+    The full job starts right after the preview, and the client's decision is read by watch_connection while it runs.
+    A failed preview is skipped and the full job continues."""
+    preview_path, error = execute_job_watched(config, connection, inputfile_path, {**req_data, 'preview_only': True}, aes_key)
+    if error is not None:
+        return error.error_code != '1014'
+
+    try:
+        error = send_encrypted_response(connection, preview_path, config['stream_rate'], aes_key, RESPONSE_PREVIEW, client_id)
+    finally:
+        global_scratch.delete([preview_path])
+    if error is not None:
+        raise Exception(error.description)
+    return True
+
+def receive_preview_decision(config, connection, aes_key) -> bool:
+    """Reads the client's decision after a preview. Returns False when the client cancelled."""
+    # Client decision: size (4 bytes) and AES-encrypted JSON {"continue": true | false}
+    connection.settimeout(config['preview_decision_timeout'])
+    try:
+        decision = json.loads(receive_encrypted_frame(connection, aes_key).decode('utf-8'))
+    except socket.timeout:
+        print('No preview decision received. Sending the result')
+        return True
+    except Exception as e:
+        # A client that closed or broke the connection will not take the result
+        print(f"Connection failed while waiting for the preview decision: {e}. Cancelling the job")
+        return False
+    finally:
+        connection.settimeout(None)
+
+    if not isinstance(decision, dict):
+        return False
+
+    return bool(decision.get('continue', True)) and not decision.get('cancel', False)
+
+def create_preview(input_filename, dir_path, req_data, config, cancel_event=None):
+    """Produces a short, low-resolution version of the requested transformation with the fastest encoder settings"""
+    action = req_data.get('action', 0)
+    input_path = os.path.join(dir_path, input_filename)
+    base_name = input_filename.split('.')[0]
+    preview_seconds = str(config['preview_seconds'])
+    preview_width = config['preview_width']
+
+    # Fast x264 settings shared by the video previews
+    fast_video = ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '30', '-c:a', 'aac', '-b:a', '64k']
+
+    match action:
+        case 1:
+            output_filename = f"{base_name}_preview.mp4"
+            options = ['-t', preview_seconds, '-i', input_path, '-vf', f'scale={preview_width}:-2'] + fast_video
+        case 2:
+            width, height = RESOLUTION_CHOICES[req_data.get('resolution', 0)]
+            # Keep the target aspect ratio at preview width
+            preview_height = round(preview_width * height / width / 2) * 2
+            output_filename = f"{base_name}_preview.mp4"
+            options = ['-t', preview_seconds, '-i', input_path, '-vf', f'scale={preview_width}:{preview_height}'] + fast_video
+        case 3:
+            output_filename = f"{base_name}_preview.mp4"
+            options = ['-t', preview_seconds, '-i', input_path, '-aspect', req_data.get('aspect_ratio', 0), '-vf', f'scale={preview_width}:-2'] + fast_video
+        case 4:
+            output_filename = f"{base_name}_preview.mp3"
+            options = ['-t', preview_seconds, '-i', input_path, '-vn', '-acodec', 'mp3', '-ab', '64k']
+        case 5:
+            startseconds = req_data.get('startseconds')
+            endseconds = req_data.get('endseconds')
+            clip_seconds = min(config['preview_seconds'], endseconds - startseconds)
+            output_filename = f"{base_name}_preview.{req_data.get('extension')}"
+            options = clip_ffmpeg_options(input_path, req_data.get('extension'), startseconds, clip_seconds, preview_width, min(config['gif_fps'], 10), config)
+        case _:
+            raise Exception(f'Unknown action: {action}')
+
+    output_path = os.path.join(dir_path, output_filename)
+    ffmpeg_cmd = ['ffmpeg', '-y'] + options + [output_path]
+
+    print(f"Running FFmpeg: {' '.join(ffmpeg_cmd)}")
+
+    run_ffmpeg(ffmpeg_cmd, cancel_event)
+    return output_filename, output_path
+
 # Response-related functions implementation starts here
-def send_encrypted_response(connection, filepath, stream_rate, aes_key):
-    # Function to return response containing processed data to client after each processing
+def send_encrypted_response(connection, filepath, stream_rate, aes_key, status_code=RESPONSE_SUCCESS, client_id=None):
+    # Function to return response containing processed data (or a preview of it) to client after each processing
     try:
         with open(filepath, 'rb') as f:
             f.seek(0, os.SEEK_END)
             file_size = f.tell()
             f.seek(0, 0)
 
-            # Success code: 1 (1 byte) and file size (8 bytes)
-            success_header = b'\x01'
-            encrypted_header = encrypt_chunk(success_header, aes_key)
+            # Success code: 1 (1 byte), or preview code: 5, and file size (8 bytes)
+            encrypted_header = encrypt_chunk(status_code, aes_key)
 
             connection.send(len(encrypted_header).to_bytes(4, 'big'))
             connection.sendall(encrypted_header)
@@ -325,6 +1804,9 @@ def send_encrypted_response(connection, filepath, stream_rate, aes_key):
 
                 encrypted_chunk = encrypt_chunk(data, aes_key)
 
+                if client_id is not None:
+                    global_clients.throttle(client_id, 'download', len(encrypted_chunk) + 4)
+
                 connection.send(len(encrypted_chunk).to_bytes(4, 'big'))
                 connection.send(encrypted_chunk)
 
@@ -337,20 +1819,33 @@ def send_encrypted_response(connection, filepath, stream_rate, aes_key):
         print(f"File transmission error: {str(error)}")
         return ErrorInfo('1004', f'File transmission error: {str(error)}', 'Please check your network connection.')
 
+def send_encrypted_frame(connection, data, aes_key):
+    # AES-encrypted data prefixed with its size (4 bytes)
+    encrypted_data = encrypt_chunk(data, aes_key)
+    connection.sendall(len(encrypted_data).to_bytes(4, 'big') + encrypted_data)
+
+def receive_encrypted_frame(connection, aes_key, max_size=MAX_CONTROL_FRAME_SIZE):
+    # The size is checked before reading, since the frame cannot be authenticated until it has been received
+    encrypted_size = int.from_bytes(receive_exact(connection, 4), 'big')
+    if encrypted_size > max_size:
+        raise Exception(f"Frame of {encrypted_size} bytes exceeds the limit of {max_size} bytes")
+    return decrypt_chunk(receive_exact(connection, encrypted_size), aes_key)
+
+def send_encrypted_message(connection, status_code, message_json, aes_key):
+    # Status code (1 byte) and JSON body, each AES encrypted and prefixed with its size (4 bytes)
+    encrypted_header = encrypt_chunk(status_code, aes_key)
+    connection.send(len(encrypted_header).to_bytes(4, 'big'))
+    connection.sendall(encrypted_header)
+
+    encrypted_json = encrypt_chunk(message_json.encode('utf-8'), aes_key)
+    connection.send(len(encrypted_json).to_bytes(4, 'big'))
+    connection.sendall(encrypted_json)
+
 def send_encrypted_error_response(connection, error_info, aes_key):
     # Function to return error response to client
     try:
         # Error code: 0 (1 byte) and error JSON (ErrorInfo object) both AES encrypted, sending data size and data
-        error_header = b'\x00'
-        encrypted_header = encrypt_chunk(error_header, aes_key)
-        connection.send(len(encrypted_header).to_bytes(4, 'big'))
-        connection.sendall(encrypted_header)
-
-        error_json = error_info.to_json()
-        error_bytes = error_json.encode('utf-8')
-        encrypted_json = encrypt_chunk(error_bytes, aes_key)
-        connection.send(len(encrypted_json).to_bytes(4, 'big'))
-        connection.sendall(encrypted_json)
+        send_encrypted_message(connection, RESPONSE_ERROR, error_info.to_json(), aes_key)
 
         print(f"Encrypted error response sent: {error_info.error_code}")
 
@@ -369,9 +1864,53 @@ def load_server_config():
         'server_port': config['server_port'],
         'max_storage': config['max_storage'],
         'dir_path': BASE_DIR + config['storage_dir'],
-        'stream_rate': config['stream_rate']
+        'stream_rate': config['stream_rate'],
+        'checkpoint_interval': config.get('checkpoint_interval', 8 * 1024 * 1024),
+        'upload_retention_seconds': config.get('upload_retention_seconds', 24 * 60 * 60),
+        'job_workers': config.get('job_workers', 1),
+        'job_poll_interval': config.get('job_poll_interval', 5),
+        'job_retention_seconds': config.get('job_retention_seconds', 7 * 24 * 60 * 60),
+        'cluster_secret': config.get('cluster_secret', ''),
+        'coordinator_address': config.get('coordinator_address', '127.0.0.1'),
+        'coordinator_port': config.get('coordinator_port', 9002),
+        'worker_address': config.get('worker_address', '127.0.0.1'),
+        'worker_port': config.get('worker_port', 9100),
+        'worker_slots': config.get('worker_slots', 1),
+        'worker_heartbeat_interval': config.get('worker_heartbeat_interval', 5),
+        'worker_timeout': config.get('worker_timeout', 15),
+        'dispatch_retries': config.get('dispatch_retries', 2),
+        'max_active_jobs': config.get('max_active_jobs', 2),
+        'upload_read_timeout': config.get('upload_read_timeout', 60),
+        'max_queue_length': config.get('max_queue_length', 8),
+        'default_job_seconds': config.get('default_job_seconds', 60),
+        'queue_status_interval': config.get('queue_status_interval', 5),
+        'scratch_ram_dir': config.get('scratch_ram_dir', '/dev/shm/video_compressor'),
+        'scratch_ram_budget': config.get('scratch_ram_budget', 256 * 1024 * 1024),
+        'preview_seconds': config.get('preview_seconds', 5),
+        'preview_width': config.get('preview_width', 320),
+        'preview_decision_timeout': config.get('preview_decision_timeout', 120),
+        'gif_max_width': config.get('gif_max_width', 480),
+        'gif_fps': config.get('gif_fps', 10),
+        'webm_deadline': config.get('webm_deadline', 'realtime'),
+        'webm_cpu_used': config.get('webm_cpu_used', 8),
+        'webm_crf': config.get('webm_crf', 35),
+        'input_store_budget': config.get('input_store_budget', 10737418240),
+        'client_weights': config.get('client_weights', {}),
+        'default_client_weight': config.get('default_client_weight', 1),
+        'client_bandwidth': config.get('client_bandwidth', 0),
+        'client_burst': config.get('client_burst', 8388608)
     }
 
+def receive_exact(connection, size):
+    """Function to receive exactly size bytes, since recv may return fewer"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise Exception("Connection closed unexpectedly")
+        data += chunk
+    return bytes(data)
+
 def delete_tmp_files(file_paths_to_delete:list):
     """Function to delete files at specified paths"""
     for file_path in file_paths_to_delete:
@@ -412,7 +1951,7 @@ class RSAManager:
         return decrypted_bytes
 
 # Video compression functions implementation starts here
-def compress_video(input_filename, dir_path):
+def compress_video(input_filename, dir_path, cancel_event=None):
     input_path = os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}_compressed.mp4"
@@ -442,34 +1981,32 @@ def compress_video(input_filename, dir_path):
 
     print(f"Running FFmpeg: {' '.join(ffmpeg_cmd)}")
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg error: {result.stderr}")
+    run_ffmpeg(ffmpeg_cmd, cancel_event)
 
     return output_filename, output_path
 
 # Video resolution and other functional functions implementation starts here
-def handle_resolution_change(input_filename, dir_path, req_data):
+RESOLUTION_CHOICES = {
+    "480p": (854, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "1440p": (2560, 1440),
+    "4K": (3840, 2160)
+}
+
+def handle_resolution_change(input_filename, dir_path, req_data, cancel_event=None, output_dir=None):
     chosen_resolution = req_data.get('resolution', 0)
 
     input_path = os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}_{chosen_resolution}.mp4"
-    output_path = os.path.join(dir_path, output_filename)
-
-    resolution_choices = {
-        "480p": (854, 480),
-        "720p": (1280, 720),
-        "1080p": (1920, 1080),
-        "1440p": (2560, 1440),
-        "4K": (3840, 2160)
-    }
+    output_path = os.path.join(output_dir or dir_path, output_filename)
 
     ffmpeg_cmd = [
         'ffmpeg',
         '-y',
         '-i', input_path,
-        '-vf', f'scale={resolution_choices[chosen_resolution][0]}:{resolution_choices[chosen_resolution][1]}',
+        '-vf', f'scale={RESOLUTION_CHOICES[chosen_resolution][0]}:{RESOLUTION_CHOICES[chosen_resolution][1]}',
         '-c:a', 'copy',
         '-preset', 'fast',
         output_path
@@ -477,19 +2014,17 @@ def handle_resolution_change(input_filename, dir_path, req_data):
 
     print(f"Running FFmpeg: {' '.join(ffmpeg_cmd)}")
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg error: {result.stderr}")
+    run_ffmpeg(ffmpeg_cmd, cancel_event)
     return output_filename, output_path
 
 # Video aspect ratio processing functions implementation starts here
-def handle_aspect_change(input_filename, dir_path, req_data):
+def handle_aspect_change(input_filename, dir_path, req_data, cancel_event=None, output_dir=None):
     chosen_aspect_ratio = req_data.get('aspect_ratio', 0)
 
     input_path = os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}_{chosen_aspect_ratio}.mp4"
-    output_path = os.path.join(dir_path, output_filename)
+    output_path = os.path.join(output_dir or dir_path, output_filename)
 
     ffmpeg_cmd = [
         'ffmpeg',
@@ -504,14 +2039,12 @@ def handle_aspect_change(input_filename, dir_path, req_data):
 
     print(f"Running FFmpeg: {' '.join(ffmpeg_cmd)}")
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg error: {result.stderr}")
+    run_ffmpeg(ffmpeg_cmd, cancel_event)
 
     return output_filename, output_path
 
 # Audio conversion processing functions implementation starts here
-def handle_video_conversion(input_filename, dir_path):
+def handle_video_conversion(input_filename, dir_path, cancel_event=None):
     input_path = os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}_audio.mp3"
@@ -531,37 +2064,71 @@ def handle_video_conversion(input_filename, dir_path):
 
     print(f"Running FFmpeg: {' '.join(ffmpeg_cmd)}")
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg error: {result.stderr}")
+    run_ffmpeg(ffmpeg_cmd, cancel_event)
     return output_filename, output_path
 
 # GIF and WEBM conversion processing functions implementation starts here
-def handle_process_video_clip(input_filename:str, dir_path:str, req_data:dict):
+def handle_process_video_clip(input_filename:str, dir_path:str, req_data:dict, config:dict, cancel_event=None, output_dir=None):
     chosen_extension = req_data.get('extension')
     startseconds = req_data.get('startseconds')
     endseconds = req_data.get('endseconds')
     input_path = os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}.{chosen_extension}"
-    output_path = os.path.join(dir_path, output_filename)
+    output_path = os.path.join(output_dir or dir_path, output_filename)
+
+    # GIFs are limited in width and frame rate, WEBM keeps the source size
+    if chosen_extension == 'gif':
+        max_width, fps = config['gif_max_width'], config['gif_fps']
+    else:
+        max_width, fps = None, None
 
     ffmpeg_cmd = [
         'ffmpeg',
-        '-y',
-        '-i', input_path,
-        '-ss', str(startseconds),
-        '-to', str(endseconds),
+        '-y'
+    ] + clip_ffmpeg_options(input_path, chosen_extension, startseconds, endseconds - startseconds, max_width, fps, config) + [
         output_path
     ]
 
     print(f"Running FFmpeg: {' '.join(ffmpeg_cmd)}")
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFmpeg error: {result.stderr}")
+    run_ffmpeg(ffmpeg_cmd, cancel_event)
     return output_filename, output_path
 
+def clip_ffmpeg_options(input_path:str, extension:str, startseconds, duration, max_width:int | None, fps:int | None, config:dict) -> list:
+    """FFmpeg input and encoding options of a GIF or WEBM clip. GIFs require max_width and fps, WEBM uses them when given"""
+    # Seeking before -i skips straight to the clip instead of decoding the video from the start
+    options = [
+        '-ss', str(startseconds),
+        '-t', str(duration),
+        '-i', input_path
+    ]
+
+    if extension == 'gif':
+        # Single pass: limit frame rate and width, build a palette for the clip and map the frames onto it
+        options += [
+            '-filter_complex',
+            f"fps={fps},scale='min({max_width},iw)':-1:flags=lanczos,split[s0][s1];"
+            "[s0]palettegen=stats_mode=diff[p];[s1][p]paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle",
+            '-loop', '0'
+        ]
+    elif extension == 'webm':
+        if max_width is not None:
+            options += ['-vf', f"fps={fps},scale='min({max_width},iw)':-2"]
+        # VP9 tuned for speed: realtime deadline, highest cpu-used and row based multithreading
+        options += [
+            '-c:v', 'libvpx-vp9',
+            '-deadline', config['webm_deadline'],
+            '-cpu-used', str(config['webm_cpu_used']),
+            '-row-mt', '1',
+            '-crf', str(config['webm_crf']),
+            '-b:v', '0',
+            '-c:a', 'libopus',
+            '-b:a', '96k'
+        ]
+
+    return options
+
 def get_video_duration(filepath:str):
     cmd = [
         'ffprobe',
@@ -584,34 +2151,78 @@ def validate_video_duration(filepath:str, endseconds:int) -> ErrorInfo | None:
 
 # Main (entry point)
 def main():
-    initialize_rsa()
+    parser = argparse.ArgumentParser(description='Video compressor server')
+    # standalone: run FFmpeg in this process, coordinator: accept clients and dispatch jobs to workers, worker: run jobs for a coordinator
+    parser.add_argument('--role', choices=['standalone', 'coordinator', 'worker'], default='standalone')
+    parser.add_argument('--worker-port', type=int, help='Port of this worker, to run several workers on one host')
+    args = parser.parse_args()
 
     config = load_server_config()
+    config['role'] = args.role
+    if args.worker_port is not None:
+        config['worker_port'] = args.worker_port
+
+    if args.role != 'standalone' and not config['cluster_secret']:
+        raise SystemExit('cluster_secret must be set in config.json to run as coordinator or worker')
+
+    initialize_scratch_storage(config)
+
+    if args.role == 'worker':
+        run_worker(config)
+        return
+
+    initialize_rsa()
+
+    initialize_uploads(config)
+    initialize_input_store(config)
+    if args.role == 'coordinator':
+        initialize_coordinator(config)
+    initialize_client_accounting(config)
+    initialize_admission(config)
+    initialize_job_queue(config)
     sock = create_server_socket(config)
 
     while True:
         connection, client_address = sock.accept()
-        print(f'Connected to {client_address}.')
+        # Each client is served on its own thread; admission control decides when its job may run
+        threading.Thread(target=serve_client, args=(config, connection, client_address), daemon=True).start()
 
-        error = None
-        aes_key = None
+def serve_client(config, connection, client_address):
+    print(f'Connected to {client_address}.')
 
-        try:
-            error, aes_key = handle_client_request(config, connection)
-
-        except Exception as e:
-            error = ErrorInfo('1002', str(e), 'If the issue persists, please contact the administrator.')
+    error = None
+    aes_key = None
 
-        finally:
-            if error is not None:
-                print(error.to_json())
-                if aes_key is not None:
-                    send_encrypted_error_response(connection, error, aes_key)
-                else:
-                    print("Cannot send unencrypted error response as AES key is not available")
+    try:
+        error, aes_key = handle_client_request(config, connection, client_address)
 
-            print('Closing connection')
-            connection.close()
+    except Exception as e:
+        error = ErrorInfo('1002', str(e), 'If the issue persists, please contact the administrator.')
+
+    finally:
+        if error is not None:
+            print(error.to_json())
+            if aes_key is not None:
+                send_encrypted_error_response(connection, error, aes_key)
+            else:
+                print("Cannot send unencrypted error response as AES key is not available")
+
+        print('Closing connection')
+        close_gracefully(connection)
+        global_clients.save()
+
+def close_gracefully(connection, timeout=5):
+    """Closes after the client has read everything. Closing with unread client data (such as a preview decision that arrived
+    after the job finished) would reset the connection and discard the end of the response on the client side."""
+    try:
+        connection.shutdown(socket.SHUT_WR)
+        connection.settimeout(timeout)
+        while connection.recv(65536):
+            pass
+    except OSError:
+        pass
+    finally:
+        connection.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file